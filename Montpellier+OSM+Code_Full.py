@@ -12,13 +12,17 @@
 
 # In[175]:
 
+import multiprocessing
+import os
+import shutil
+import zlib
 import xml.etree.cElementTree as ET  
 from collections import defaultdict
 
 OSM_FILE = r"C:\Users\schro\Desktop\Projects\Data Analysis Nanodegree\P3- Data Wrangling\Montpellier.osm"  
 SAMPLE_FILE = "sample2.osm"
 
-k = 100 # Parameter: take every k-th top level element
+k = 100 # Parameter: sample roughly one in k ways (and the nodes they use)
 
 def get_element(osm_file, tags=('node', 'way', 'relation')):
 
@@ -30,16 +34,278 @@ def get_element(osm_file, tags=('node', 'way', 'relation')):
             root.clear()
 
 
-with open(SAMPLE_FILE, 'wb') as output:
-    output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-    output.write('<osm>\n  ')
-
-    # Write every kth top level element
-    for i, element in enumerate(get_element(OSM_FILE)):
-        if i % k == 0:
-            output.write(ET.tostring(element, encoding='utf-8'))
-
-    output.write('</osm>')
+# Taking every k-th element gave a sample full of ways whose nodes were not in it. The sampler below picks elements by a hash of their id, so the same ids are picked on every run and every sample of fraction f is contained in the samples of larger fractions. A bounding box can be given instead to keep only nodes inside it (and the ways using them). Every way picked is written with all of its nodes. Relations are left out of the samples since their members would need the same closure.
+# 
+# The extract can be split into shards with split_osm_file, and each pass of the sampler then runs over the shards in parallel: the first pass picks nodes (and ways, when sampling by id), the second picks the ways touching picked nodes (only with a bounding box) and the last writes every sample at once.
+
+SAMPLE_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<osm>\n  '
+SAMPLE_FOOTER = '</osm>'
+
+def id_fraction(element_id):
+    """Stable pseudo-random number in [0, 1) for an element id"""
+    return (zlib.crc32(element_id) & 0xffffffff) / 4294967296.0
+
+
+def in_bbox(element, bbox):
+    min_lat, min_lon, max_lat, max_lon = bbox
+    return (min_lat <= float(element.attrib['lat']) <= max_lat and
+            min_lon <= float(element.attrib['lon']) <= max_lon)
+
+
+def split_osm_file(osm_file, shards, prefix=None):
+    """Split an .osm file into shards of roughly equal size, keeping the element order"""
+    prefix = prefix or os.path.splitext(osm_file)[0]
+    shard_bytes = os.path.getsize(osm_file) // shards + 1
+    paths = []
+    output = None
+    written = 0
+    for element in get_element(osm_file):
+        if output is None or (written >= shard_bytes and len(paths) < shards):
+            if output is not None:
+                output.write(SAMPLE_FOOTER)
+                output.close()
+            paths.append('{}.part{}.osm'.format(prefix, len(paths)))
+            output = open(paths[-1], 'wb')
+            output.write(SAMPLE_HEADER)
+            written = 0
+        data = ET.tostring(element, encoding='utf-8')
+        output.write(data)
+        written += len(data)
+    if output is not None:
+        output.write(SAMPLE_FOOTER)
+        output.close()
+    return paths
+
+
+def sample_pick(args):
+    """First pass over a shard: the ids picked for each fraction, and the nodes the picked ways use"""
+    shard, fractions, bbox = args
+    nodes = [set() for _ in fractions]
+    ways = [set() for _ in fractions]
+    refs = [set() for _ in fractions]
+    for element in get_element(shard, tags=('node', 'way')):
+        f = id_fraction(element.attrib['id'])
+        for i, fraction in enumerate(fractions):
+            if f >= fraction:
+                continue
+            if element.tag == 'node':
+                if bbox is None or in_bbox(element, bbox):
+                    nodes[i].add(element.attrib['id'])
+            elif bbox is None:
+                ways[i].add(element.attrib['id'])
+                refs[i].update(nd.attrib['ref'] for nd in element.iter('nd'))
+    return nodes, ways, refs
+
+
+def sample_pick_ways(args):
+    """Second pass over a shard (bbox only): the ways using a picked node, and all of their nodes"""
+    shard, nodes = args
+    ways = [set() for _ in nodes]
+    refs = [set() for _ in nodes]
+    for element in get_element(shard, tags=('way',)):
+        way_refs = [nd.attrib['ref'] for nd in element.iter('nd')]
+        for i, picked in enumerate(nodes):
+            if any(ref in picked for ref in way_refs):
+                ways[i].add(element.attrib['id'])
+                refs[i].update(way_refs)
+    return ways, refs
+
+
+def sample_write(args):
+    """Last pass over a shard: write the picked elements of every sample to its own part file"""
+    shard, samples = args
+    outputs = [open(out_file, 'wb') for out_file, _, _ in samples]
+    written = [{'node': 0, 'way': 0} for _ in samples]
+    try:
+        for element in get_element(shard, tags=('node', 'way')):
+            for output, counts, (_, nodes, ways) in zip(outputs, written, samples):
+                if element.attrib['id'] in (nodes if element.tag == 'node' else ways):
+                    output.write(ET.tostring(element, encoding='utf-8'))
+                    counts[element.tag] += 1
+    finally:
+        for output in outputs:
+            output.close()
+    return written
+
+
+def sample_osm(shards, samples, bbox=None, workers=None):
+    """Write samples of an .osm file (or of its shards) in one set of passes.
+
+    samples maps each output file to the fraction of ids to keep. With bbox,
+    (min_lat, min_lon, max_lat, max_lon), the fraction is taken from the nodes
+    inside the box only.
+    """
+    if isinstance(shards, basestring):
+        shards = [shards]
+    out_files = sorted(samples)
+    fractions = [samples[out_file] for out_file in out_files]
+    pool = multiprocessing.Pool(workers) if workers != 1 and len(shards) > 1 else None
+    run = pool.map if pool is not None else map
+    try:
+        nodes = [set() for _ in fractions]
+        ways = [set() for _ in fractions]
+        refs = [set() for _ in fractions]
+        for picked in run(sample_pick, [(shard, fractions, bbox) for shard in shards]):
+            for merged, found in zip((nodes, ways, refs), picked):
+                for ids, shard_ids in zip(merged, found):
+                    ids.update(shard_ids)
+        if bbox is not None:
+            for picked in run(sample_pick_ways, [(shard, nodes) for shard in shards]):
+                for merged, found in zip((ways, refs), picked):
+                    for ids, shard_ids in zip(merged, found):
+                        ids.update(shard_ids)
+        for ids, way_refs in zip(nodes, refs):
+            ids.update(way_refs)
+
+        jobs = []
+        for n, shard in enumerate(shards):
+            jobs.append((shard, [('{}.part{}'.format(out_file, n), nodes[i], ways[i])
+                                 for i, out_file in enumerate(out_files)]))
+        parts = run(sample_write, jobs)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    written = {}
+    for i, out_file in enumerate(out_files):
+        written[out_file] = {'node': 0, 'way': 0}
+        with open(out_file, 'wb') as output:
+            output.write(SAMPLE_HEADER)
+            for n, (_, shard_samples) in enumerate(jobs):
+                with open(shard_samples[i][0], 'rb') as part:
+                    shutil.copyfileobj(part, output)
+                os.remove(shard_samples[i][0])
+                for tag in ('node', 'way'):
+                    written[out_file][tag] += parts[n][i][tag]
+            output.write(SAMPLE_FOOTER)
+    return written
+
+
+sample_osm(OSM_FILE, {SAMPLE_FILE: 1.0 / k})
+
+# For CI and quick checks of the cleaning rules:
+# shards = split_osm_file(OSM_FILE, 8)
+# sample_osm(shards, {'sample_1pct.osm': 0.01, 'sample_10pct.osm': 0.1}, workers=8)
+# sample_osm(shards, {'ecusson.osm': 1.0}, bbox=(43.605, 3.87, 43.615, 3.885))
+
+
+# Each of the audits below (counting tags, classifying keys, checking street names, postcodes and cities) was first written as its own loop over the file, so auditing meant reading the whole file four or five times. The AuditEngine reads the file once: audits are registered as visitor functions that take a top level element and a state object (the same pattern as key_type(element, keys) below), and every element is handed to every visitor before it is cleared from memory. The root element is also passed to the visitors once, without its children.
+
+# In[151]:
+
+class AuditEngine(object):
+    """Run several audits over an osm file in a single streaming pass"""
+
+    def __init__(self):
+        self.audits = []
+
+    def register(self, name, visit, state):
+        self.audits.append((name, visit, state))
+        return self
+
+    def run(self, osm_file):
+        context = ET.iterparse(osm_file, events=('start', 'end'))
+        _, root = next(context)
+        #the parser may already have read ahead into the children, so visit a childless copy of the root
+        for name, visit, state in self.audits:
+            visit(ET.Element(root.tag, root.attrib), state)
+
+        depth = 1
+        self.max_retained = 0
+        for event, elem in context:
+            if event == 'start':
+                depth += 1
+                continue
+            depth -= 1
+            #a top level element (node, way, relation...) is complete, audit it then free it
+            if depth == 1:
+                for name, visit, state in self.audits:
+                    visit(elem, state)
+                self.max_retained = max(self.max_retained, len(root))
+                root.clear()
+        return self.report()
+
+    def report(self):
+        return dict((name, state) for name, visit, state in self.audits)
+
+
+#visitors used by audit_map, each one wraps one of the audits below
+def count_tags_visitor(element, tag_dic):
+    for elem in element.iter():
+        tag_dic[elem.tag] = tag_dic.get(elem.tag, 0) + 1
+
+def key_type_visitor(element, keys):
+    for tag in element.iter('tag'):
+        key_type(tag, keys)
+
+def street_visitor(element, street_types_list):
+    if element.tag == 'node' or element.tag == 'way':
+        for tag in element.iter('tag'):
+            if is_street_name(tag):
+                audit_street_type(street_types_list, tag.attrib['v'])
+
+def postcode_visitor(element, code_a_list):
+    if element.tag == 'node' or element.tag == 'way':
+        for tag in element.iter('tag'):
+            if tag.attrib['k'] == "addr:postcode":
+                investigate_zip(tag.attrib['v'], code_a_list)
+
+def city_visitor(element, city_list):
+    if element.tag == 'node' or element.tag == 'way':
+        for tag in element.iter('tag'):
+            if tag.attrib['k'] == "addr:city":
+                update_name_city(tag.attrib['v'], city_list)
+
+
+def audit_engine():
+    """AuditEngine with every audit registered"""
+    engine = AuditEngine()
+    engine.register('tag_counts', count_tags_visitor, {})
+    engine.register('key_types', key_type_visitor,
+                    {"lower": 0, "lower_colon": 0, "lower_double_colon": 0, "problemchars": 0, "other": 0})
+    engine.register('street_types', street_visitor, defaultdict(set))
+    engine.register('postcodes', postcode_visitor, set())
+    engine.register('cities', city_visitor, set())
+    return engine
+
+def audit_map(osm_file):
+    """Tag counts, key classes, nonconforming streets, bad postcodes and unknown cities in one pass"""
+    return audit_engine().run(osm_file)
+
+
+# The individual audits further down (count_tags, key_type's process_map, updated_street_name and audit_zip) also go through the AuditEngine, so none of them keeps the parsed tree in memory. check_audit_memory runs the full audit over a file and checks that it really is constant memory: no more than max_retained top level elements may be held under the root at any time (the parser reads ahead in 16 KB blocks, so this is a bit more than one, but it doesn't grow with the file), and (where the resource module is available) the peak memory of the process may not grow by more than max_growth_mb.
+
+# In[153]:
+
+import sys
+
+try:
+    import resource
+except ImportError: #not available on Windows
+    resource = None
+
+def peak_memory_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+def check_audit_memory(osm_file, max_retained=1000, max_growth_mb=100):
+    """Run every audit over osm_file and raise if the memory held while parsing grows with the file"""
+    engine = audit_engine()
+    before = peak_memory_mb()
+    engine.run(osm_file)
+    after = peak_memory_mb()
+
+    result = {'max_retained': engine.max_retained,
+              'peak_growth_mb': None if before is None else after - before}
+    if engine.max_retained > max_retained:
+        raise Exception("Parser kept {0} elements in memory".format(engine.max_retained))
+    if result['peak_growth_mb'] is not None and result['peak_growth_mb'] > max_growth_mb:
+        raise Exception("Peak memory grew by {0:.1f} MB while auditing".format(result['peak_growth_mb']))
+    return result
 
 
 # Below, I've created a dictionary containing all tags in the XML dataset, and the number of each type. These tags refer to elements within the Open Street Map (OSM) data, as well as tags for each element. 
@@ -53,19 +319,15 @@ with open(SAMPLE_FILE, 'wb') as output:
 # In[152]:
 
 
-osm_file = open(data, "r")
 street_types = defaultdict(set)
-i=0
-for event, elem in ET.iterparse(osm_file, events=("start",)):
-    if i<100000 and i>80100:
-        if elem.tag=="node":
-            #print elem.tag, elem.attrib
-            for tag in elem.iter("tag"):
-                if tag != None:
-                    print "------",tag.tag, tag.attrib
-        
-    i+=1
-osm_file.close()
+#print the tags of a slice of the nodes, get_element clears each node once it has been read
+for i, elem in enumerate(get_element(SAMPLE_FILE, tags=('node',))):
+    if i>=1000:
+        break
+    if i>800:
+        #print elem.tag, elem.attrib
+        for tag in elem.iter("tag"):
+            print "------",tag.tag, tag.attrib
 
 
 # The function 'count_tags' counts the number of different elements and tags (used to describe features of elements) in the file. Output shown below.
@@ -76,14 +338,8 @@ osm_file.close()
 import xml.etree.cElementTree as ET
 data=SAMPLE_FILE 
 def count_tags(filename):
-    tag_dic={}
-    for event, elem in ET.iterparse(filename):
-        tagi=elem.tag
-        if tagi in tag_dic:
-            tag_dic[tagi]=tag_dic[tagi]+1
-        else:
-            tag_dic[tagi]=1
-    return tag_dic
+    #streams through the AuditEngine so each element is cleared once it has been counted
+    return AuditEngine().register('tag_counts', count_tags_visitor, {}).run(filename)['tag_counts']
             
 count_tags(data)
 
@@ -122,10 +378,7 @@ def key_type(element, keys):
 
 def process_map(data):
     keys = {"lower": 0, "lower_colon": 0, "lower_double_colon":0, "problemchars": 0, "other": 0}
-    for _, element in ET.iterparse(data):
-        keys = key_type(element, keys)
-
-    return keys
+    return AuditEngine().register('key_types', key_type_visitor, keys).run(data)['key_types']
 process_map(data)
 
 
@@ -150,43 +403,38 @@ mapping = { "av.": "Avenue",
             "blvd":"Boulevard",
             "blvd.":"Boulevard"
             }
+
+#expected words for the start of a street name
+expected = {"Rue", "Avenue", "Boulevard", "Route", "Chemin", "Place", "Impasse",u"All\xe9e", 'Voie','Esplanade'}
+
+#add upper and lowercase versions of the words to the list (done once, not on every street)
+for x in expected.copy():
+    expected.add(x.lower())
+    expected.add(x.upper())
+
 #checks if element is in 'street' format for attribute
 def is_street_name(elem):
     return (elem.attrib['k'] == "addr:street")
 
 def update_name(name, mapping):
-    updated_name_list=[]
     name_list=name.split()
     updated_names=name
     
-    #first check if road name begins in middle of phrase
-    for road in expected:
-        if road in name_list:
-            i=0
-            for name in name_list:
-                if name==road:
-                    updated_name_list=name_list[i:]
-                    updated_names=' '.join(updated_name_list)
-                    break
-                else:
-                    i+=1
+    #first check if road name begins in middle of phrase, in a single pass over the words
+    for i, word in enumerate(name_list):
+        if word in expected:
+            updated_names=' '.join(name_list[i:])
+            break
             
     #if not, check if first word can be mapped to a different word
 
-    if name_list[0] in mapping.keys():
+    if name_list[0] in mapping:
             name_list[0] = mapping[name_list[0]]
             updated_names=' '.join(name_list)
     return updated_names
     
 #builds set of nonconforming street names
 def audit_street_type(street_types_list, street_name):
-    expected = {"Rue", "Avenue", "Boulevard", "Route", "Chemin", "Place", "Impasse",u"All\xe9e", 'Voie','Esplanade'}
-
-#add upper and lowercase versions of the words to the list
-    for x in expected.copy():
-        expected.add(x.lower())
-        expected.add(x.upper())
-    
     street_type=street_name.split()[0]
     if street_type not in expected: 
             street_types_list[street_type].add(street_name) #adds street to list for reference
@@ -199,16 +447,8 @@ def audit_street_type(street_types_list, street_name):
 #parses through file to audit street names
 #this function is not used in the main function, but only when a file must be opened and parsed from scratch
 def updated_street_name(osmfile):
-    osm_file = open(osmfile, "r")
     street_types = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    tag.attrib['v']=audit_street_type(street_types, tag.attrib['v'])
-    osm_file.close()
-    return street_types
+    return AuditEngine().register('street_types', street_visitor, street_types).run(osmfile)['street_types']
 
 updated_street_name(SAMPLE_FILE)
 
@@ -231,28 +471,17 @@ import re
 def investigate_zip(zip_value,code_list):
     new_code=zip_value
     if len(zip_value)>5: #check for postcodes with text appended 
-        code_list.add(tag.attrib['v']) #add to list for reference
+        code_list.add(zip_value) #add to list for reference
         new_code=new_code[:5]
     if zip_value[:2] !='34': #check for non-Herault codes
         new_code='error' #entry to be discluded later
-        code_list.add(tag.attrib['v'])
+        code_list.add(zip_value)
     return new_code
     
 #parses through file to audit zip codes in osm file
 def audit_zip(osmfile):
     code_a_list=set() #to reference bad zips
-    osm_file = open(osmfile, "r")
-    new_code=""
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if tag.attrib['k'] == "addr:postcode":
-                    #fix errors in postcode
-                    new_code=tag.attrib['v']
-                    investigate_zip(new_code,code_a_list)
-                        
-    osm_file.close()
+    return AuditEngine().register('postcodes', postcode_visitor, code_a_list).run(osmfile)['postcodes']
 audit_zip(SAMPLE_FILE)
     
 
@@ -263,16 +492,13 @@ audit_zip(SAMPLE_FILE)
 
 import re
 
-def update_name_city(name,other_cities):
-    
-    updated_names=name #keep invalid names in dataset
-    expected_codes = {"Montpellier",'MONTPELLIER',u'Lav\xe9rune',u'Le Cr\xe8s', 'montpellier', 'Grabels', 'Mauguio', 
+expected_codes = {"Montpellier",'MONTPELLIER',u'Lav\xe9rune',u'Le Cr\xe8s', 'montpellier', 'Grabels', 'Mauguio', 
                   'Lattes','LATTES', 'Jacou', 'Castelnau-le-Lez','juvignac', 'Juvignac',
                   u'Saint-Cl\xe9ment-de-Rivi\xe8re','Montferrier-sur-Lez',u'P\xe9rols','Clapiers',u'Saint-Jean-de-V\xe9das'}
 
 
-#create dictionary of things to change faulty street names to
-    mapping_city = { "Castelnau le Lez": "Castelnau-le-Lez",
+#create dictionary of things to change faulty city names to
+mapping_city = { "Castelnau le Lez": "Castelnau-le-Lez",
                 "Montpelier": "Montpellier",
                 "Saint-Jean-de-Vedas":u'Saint-Jean-de-V\xe9das',
                 "Montpelle":"Montpellier",
@@ -281,14 +507,252 @@ def update_name_city(name,other_cities):
                  u'Saint Cl\xe9ment de riviere':u'Saint-Cl\xe9ment-de-Rivi\xe8re',
                 'Maurin':'Lattes'
                 }
+
+def update_name_city(name,other_cities):
+    
+    updated_names=name #keep invalid names in dataset
     if name not in expected_codes:
         other_cities.add(name)
-        print other_cities
-        if name in mapping_city.keys():
+        if name in mapping_city:
             updated_names = mapping_city[name]
     return updated_names
 
 
+# When a run over the full file is slow, the stray print statements don't say whether the time goes to parsing, the address cleaners, the validation or the writers. The Instruments object below collects that while process_map runs: the time spent in each stage (the time of a stage doesn't include the stages it calls, so the parser's time isn't counted again in shape), event counters, elements and tags per second, the hit, miss and fix counts of the AddressCleaner, and the postcodes and cities that were not in the reference sets. It can print a progress line every progress_every elements, and report() returns everything as a dict that process_map can write to a JSON file. With profile='cprofile' the run is also profiled with cProfile, and with profile='sample' the running function is sampled every few milliseconds (on systems with SIGPROF). Instrumentation is off by default; the counters are always kept, but they are only used for rare events such as tags with a missing value, and the timers aren't touched at all.
+# 
+# instruments.enable(progress_every=100000)
+# process_map(OSM_FILE, validate=True, report_path='process_map.json')
+
+# In[306]:
+
+import cProfile
+import json
+import signal
+import time
+
+class Instruments(object):
+    """Stage timers, counters and throughput for process_map, off unless enabled"""
+
+    def __init__(self):
+        self.enabled = False
+        self.progress_every = None
+        self.profile = None
+        self.reset()
+
+    def enable(self, progress_every=None, profile=None, sample_interval=0.005):
+        self.enabled = True
+        self.progress_every = progress_every
+        self.profile = profile
+        self.sample_interval = sample_interval
+        self.reset()
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.samples = defaultdict(int)
+        self.stack = []
+        self.elements = 0
+        self.tags = 0
+        self.begun = self.started = time.time()
+        self.ended = None
+        self.profiler = None
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def start(self, stage):
+        now = time.time()
+        if self.stack:
+            self.seconds[self.stack[-1]] += now - self.started
+        self.stack.append(stage)
+        self.started = now
+
+    def stop(self):
+        now = time.time()
+        stage = self.stack.pop()
+        self.seconds[stage] += now - self.started
+        self.calls[stage] += 1
+        self.started = now
+
+    def timed(self, stage, iterable):
+        """Yield from iterable, timing each step as stage"""
+        iterator = iter(iterable)
+        while True:
+            self.start(stage)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.stop()
+                return
+            self.stop()
+            yield item
+
+    def element(self, el):
+        self.elements += 1
+        self.tags += sum(len(el[part]) for part in TAG_PARTS if part in el)
+        if self.progress_every and self.elements % self.progress_every == 0:
+            elapsed = time.time() - self.begun
+            print '{0} elements, {1:.0f} elements/s, {2:.0f} tags/s'.format(
+                self.elements, self.elements / elapsed, self.tags / elapsed)
+
+    def sample(self, signum, frame):
+        self.samples[frame.f_code.co_name, frame.f_code.co_filename, frame.f_lineno] += 1
+
+    def begin(self):
+        self.reset()
+        if self.profile == 'cprofile':
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif self.profile == 'sample' and hasattr(signal, 'setitimer'):
+            #keep whatever handler and timer were there before, end() puts them back
+            self.previous_handler = signal.signal(signal.SIGPROF, self.sample)
+            self.previous_timer = signal.setitimer(signal.ITIMER_PROF, self.sample_interval, self.sample_interval)
+
+    def end(self, profile_path='process_map.prof'):
+        self.ended = time.time()
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(profile_path)
+        elif self.profile == 'sample' and hasattr(signal, 'setitimer'):
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            #a handler installed from C is reported as None and can't be passed back
+            previous = self.previous_handler
+            signal.signal(signal.SIGPROF, signal.SIG_DFL if previous is None else previous)
+            signal.setitimer(signal.ITIMER_PROF, *self.previous_timer)
+
+    def report(self):
+        elapsed = (self.ended or time.time()) - self.begun
+        return {'seconds': elapsed, 'elements': self.elements, 'tags': self.tags,
+                'elements_per_sec': self.elements / elapsed if elapsed else 0.0,
+                'tags_per_sec': self.tags / elapsed if elapsed else 0.0,
+                'stages': dict((stage, {'seconds': seconds, 'calls': self.calls[stage]})
+                               for stage, seconds in self.seconds.iteritems()),
+                'counters': dict(self.counters), 'cleaner': address_cleaner.stats(),
+                'invalid_postcodes': sorted(code_list), 'other_cities': sorted(other_cities),
+                'samples': [[n, name, path, line] for (name, path, line), n in
+                            sorted(self.samples.iteritems(), key=lambda item: -item[1])[:25]]}
+
+    def write_report(self, path):
+        with open(path, 'w') as fout:
+            json.dump(self.report(), fout, indent=2, sort_keys=True)
+
+instruments = Instruments()
+
+
+# The same street, postcode and city strings come up thousands of times in the full file, so there's no need to clean each one from scratch. The AddressCleaner remembers the result for each distinct raw value (up to maxsize values per cleaner, dropping the least recently used) along with whether it belonged in the reference sets, so the sets are still filled in on a cache hit. stats() gives the hit rate for each cleaner.
+
+# In[307]:
+
+from collections import OrderedDict
+
+_MISSING = object()
+
+class LRUCache(object):
+    """Bounded memo that drops the least recently used value when full"""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.data.pop(key, _MISSING)
+        if value is _MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.data[key] = value #move to most recently used
+        return value
+
+    def put(self, key, value):
+        self.data[key] = value
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+        return value
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.data),
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+
+class AddressCleaner(object):
+    """Memoized street, postcode and city cleaning used by shape_element"""
+
+    def __init__(self, maxsize=10000):
+        self.streets = LRUCache(maxsize)
+        self.postcodes = LRUCache(maxsize)
+        self.cities = LRUCache(maxsize)
+        self.fixed = defaultdict(int) #values changed (or dropped) by each cleaner
+
+    def street(self, street_types_list, street_name):
+        cached = self.streets.get(street_name)
+        if cached is _MISSING:
+            if instruments.enabled:
+                instruments.start('audit_street_type')
+            street_type = street_name.split()[0]
+            if street_type in expected:
+                street_type = None
+            cached = self.streets.put(street_name, (audit_street_type(street_types_list, street_name), street_type))
+            if instruments.enabled:
+                instruments.stop()
+        elif cached[1] is not None:
+            street_types_list[cached[1]].add(street_name)
+        if cached[0] != street_name:
+            self.fixed['street'] += 1
+        return cached[0]
+
+    def postcode(self, zip_value, code_list):
+        cached = self.postcodes.get(zip_value)
+        if cached is _MISSING:
+            if instruments.enabled:
+                instruments.start('investigate_zip')
+            flagged = set()
+            cached = self.postcodes.put(zip_value, (investigate_zip(zip_value, flagged), bool(flagged)))
+            if instruments.enabled:
+                instruments.stop()
+        if cached[1]:
+            code_list.add(zip_value)
+        if cached[0] != zip_value:
+            self.fixed['postcode'] += 1
+        return cached[0]
+
+    def city(self, name, other_cities):
+        cached = self.cities.get(name)
+        if cached is _MISSING:
+            if instruments.enabled:
+                instruments.start('update_name_city')
+            cached = self.cities.put(name, (update_name_city(name, other_cities), name not in expected_codes))
+            if instruments.enabled:
+                instruments.stop()
+        elif cached[1]:
+            other_cities.add(name)
+        if cached[0] != name:
+            self.fixed['city'] += 1
+        return cached[0]
+
+    def stats(self):
+        stats = {'street': self.streets.stats(), 'postcode': self.postcodes.stats(), 'city': self.cities.stats()}
+        for cleaner, cleaner_stats in stats.iteritems():
+            cleaner_stats['fixed'] = self.fixed[cleaner]
+        return stats
+
+address_cleaner = AddressCleaner()
+
+
+# With all of the audits defined, audit_map (see the AuditEngine above) runs them together in one pass over the file.
+
+# In[308]:
+
+audit_report = audit_map(SAMPLE_FILE)
+audit_report['postcodes'], audit_report['cities']
+
+
 # ## Section 2. Parsing data into SQL Database
 # 
 # In order to put this data into an SQL database, I will parse each element in the XML file, putting them into a tabular format that can be written to a .csv file. I'm using a schema and validation library to check the data before writing the data structures to new .csv files.
@@ -303,9 +767,13 @@ def update_name_city(name,other_cities):
 
 import csv
 import codecs
+import json
+import os
 import pprint
+from pprint import pformat
 import re
 import xml.etree.cElementTree as ET
+from xml.parsers import expat
 
 import cerberus
 
@@ -321,11 +789,24 @@ NODE_TAGS_PATH = "nodes_tags.csv"
 WAYS_PATH = "ways.csv"
 WAY_NODES_PATH = "ways_nodes.csv"
 WAY_TAGS_PATH = "ways_tags.csv"
+RELATIONS_PATH = "relations.csv"
+RELATION_MEMBERS_PATH = "relations_members.csv"
+RELATION_TAGS_PATH = "relations_tags.csv"
 
 LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
 PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 
-SCHEMA = schema.schema
+SCHEMA = dict(schema.schema)
+
+#schema.py only describes nodes and ways, relations are checked with the same rules as ways
+SCHEMA.setdefault('relation', schema.schema['way'])
+SCHEMA.setdefault('relation_tags', schema.schema['way_tags'])
+SCHEMA.setdefault('relation_members', {'type': 'list', 'schema': {'type': 'dict', 'schema': {
+    'id': {'required': True, 'type': 'integer', 'coerce': int},
+    'member_id': {'required': True, 'type': 'integer', 'coerce': int},
+    'member_type': {'required': True, 'type': 'string'},
+    'role': {'required': True, 'type': 'string'},
+    'position': {'required': True, 'type': 'integer', 'coerce': int}}}})
 
 # Make sure the fields order in the csvs matches the column order in the sql table schema
 NODE_FIELDS = ['id', 'lat', 'lon', 'user', 'uid', 'version', 'changeset', 'timestamp']
@@ -333,11 +814,17 @@ NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
+RELATION_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
+RELATION_TAGS_FIELDS = ['id', 'key', 'value', 'type']
+RELATION_MEMBERS_FIELDS = ['id', 'member_id', 'member_type', 'role', 'position']
+
+#keys of the tag lists in the shaped elements
+TAG_PARTS = ('node_tags', 'way_tags', 'relation_tags')
 
 
 def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
-                  problem_chars=PROBLEMCHARS, default_tag_type='regular'):
-    """Clean and shape node or way XML element to Python dict"""
+                  problem_chars=PROBLEMCHARS, default_tag_type='regular', clean=True):
+    """Clean and shape node, way or relation XML element to Python dict"""
 
     node_attribs = {}
     way_attribs = {}
@@ -356,25 +843,28 @@ def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIE
             dic={}
             #skip values with missing values
             if minitag.attrib['v'] == '' or minitag.attrib['v'] == None or minitag.attrib['k'] == '' or minitag.attrib['k'] == None:
-                print 'found a missing value'
+                instruments.count('missing_values')
                 continue
             
             if PROBLEMCHARS.search(minitag.attrib["k"])==None:
                 
+                #with clean=False the address tags are cleaned later in batches, see shape_columnar
+                if not clean:
+                    pass
                 #first,fix streetname
-                if minitag.attrib['k'] == "addr:street":
+                elif minitag.attrib['k'] == "addr:street":
                     #change road name to fixed name 
-                    minitag.attrib['v']=audit_street_type(street_types, minitag.attrib['v'])
+                    minitag.attrib['v']=address_cleaner.street(street_types, minitag.attrib['v'])
                     
-                if minitag.attrib['k'] == "addr:postcode":
+                elif minitag.attrib['k'] == "addr:postcode":
                     #fix postcodes
-                    minitag.attrib['v']=investigate_zip(minitag.attrib['v'],code_list)
+                    minitag.attrib['v']=address_cleaner.postcode(minitag.attrib['v'],code_list)
                     #for invalid postcodes, or from areas outside of the Herault region, do not include entry
                     if minitag.attrib['v']=='error':
                         continue
-                if minitag.attrib['k'] == "addr:city":
+                elif minitag.attrib['k'] == "addr:city":
                     #fix cities
-                    minitag.attrib['v']=update_name_city(minitag.attrib['v'],other_cities)
+                    minitag.attrib['v']=address_cleaner.city(minitag.attrib['v'],other_cities)
                 
                     
                 dic["id"]=element.attrib["id"]
@@ -416,6 +906,26 @@ def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIE
             i+=1
         
         return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
+    elif element.tag == 'relation':
+        relation_attribs=attach_attrib(RELATION_FIELDS)
+        tags=subnodes(element)
+
+        members=[]
+        i=0
+        for minitag in element.iter("member"):
+            #skip members with missing references
+            if minitag.attrib['ref'] == '' or minitag.attrib['ref'] == None:
+                continue
+            dic={}
+            dic["id"]=element.attrib["id"]
+            dic["member_id"]=minitag.attrib["ref"]
+            dic["member_type"]=minitag.attrib["type"]
+            dic["role"]=minitag.attrib.get("role", "")
+            dic['position']=i
+            members.append(dic)
+            i+=1
+
+        return {'relation': relation_attribs, 'relation_members': members, 'relation_tags': tags}
 
 
 # ================================================== #
@@ -432,16 +942,211 @@ def get_element(osm_file, tags=('node', 'way', 'relation')):
             root.clear()
 
 
+#process_map can also read the file with the parsers below (parser='lxml' or parser='expat'), but they don't make
+#it faster: on sample2.osm repeated 10 times, lxml parses quicker than get_element but the whole run takes the
+#same time, and expat is slower because every start and end tag calls back into python while cElementTree's
+#iterparse stays in C. get_element remains the default. RawElement is also what get_element_pbf yields.
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+
+class RawElement(object):
+    """Just enough of an Element (tag, attrib, iter) for shape_element, built by the expat parser"""
+
+    __slots__ = ('tag', 'attrib', 'children')
+
+    def __init__(self, tag, attrib):
+        self.tag = tag
+        self.attrib = attrib
+        self.children = []
+
+    def iter(self, tag=None):
+        return [child for child in self.children if tag is None or child.tag == tag]
+
+
+def get_element_expat(osm_file, tags=('node', 'way', 'relation'), buffer_size=2 ** 16):
+    """Yield a RawElement for each element of the right type, using expat without building a tree"""
+
+    parser = expat.ParserCreate()
+    found = []
+    state = {'current': None}
+
+    def start(name, attrib):
+        current = state['current']
+        if current is None:
+            if name in tags:
+                state['current'] = RawElement(name, attrib)
+        else:
+            current.children.append(RawElement(name, attrib))
+
+    def end(name):
+        current = state['current']
+        if current is not None and name == current.tag:
+            found.append(current)
+            state['current'] = None
+
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+
+    with open(osm_file, 'rb') as f:
+        while True:
+            data = f.read(buffer_size)
+            parser.Parse(data, not data)
+            for element in found:
+                yield element
+            del found[:]
+            if not data:
+                break
+
+
+def get_element_lxml(osm_file, tags=('node', 'way', 'relation')):
+    """Yield element if it is the right type of tag, letting lxml skip everything else"""
+
+    if lxml_etree is None:
+        raise ImportError("the 'lxml' parser needs the lxml package")
+    for _, elem in lxml_etree.iterparse(osm_file, events=('end',), tag=tags):
+        yield elem
+        #free the element and everything before it under the root
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+PARSERS = {'etree': get_element, 'expat': get_element_expat, 'lxml': get_element_lxml}
+
+def get_parser(parser):
+    if parser not in PARSERS:
+        raise ValueError("Unknown parser '{0}', use one of {1}".format(parser, sorted(PARSERS)))
+    return PARSERS[parser]
+
+
 def validate_element(element, validator, schema=SCHEMA):
     """Raise ValidationError if element does not match schema"""
     if validator.validate(element, schema) is not True:
         field, errors = next(validator.errors.iteritems())
         message_string = "\nElement of type '{0}' has the following errors:\n{1}"
-        error_string = pprint.pformat(errors)
+        error_string = pformat(errors)
         
         raise Exception(message_string.format(field, error_string))
 
 
+TYPE_CHECKS = {
+    'string': lambda value: isinstance(value, basestring),
+    'integer': lambda value: isinstance(value, (int, long)),
+    'float': lambda value: isinstance(value, (float, int, long)),
+    'dict': lambda value: isinstance(value, dict),
+    'list': lambda value: isinstance(value, (list, tuple)),
+}
+
+def compile_field(name, rules, coerce_last=False):
+    """Turn the cerberus rules for one field into a function returning its error list
+
+    cerberus lists a coercion error before the other errors of a field, except
+    in the items of a list, where it comes last (coerce_last).
+    """
+    required = rules.get('required', False)
+    nullable = rules.get('nullable', False)
+    coerce = rules.get('coerce')
+    type_name = rules.get('type')
+    type_check = TYPE_CHECKS.get(type_name)
+    check_dict = compile_schema(rules['schema'], coerce_last) if type_name == 'dict' and 'schema' in rules else None
+    check_item = compile_field(None, rules['schema'], True) if type_name == 'list' and 'schema' in rules else None
+
+    def check(value):
+        messages = []
+        coerce_messages = []
+        if coerce is not None:
+            try:
+                value = coerce(value)
+            except Exception as e:
+                coerce_messages.append("field '{0}' cannot be coerced: {1}".format(name, e))
+        if value is None:
+            #as in cerberus, a None value skips the other rules
+            if not nullable:
+                messages.append('null value not allowed')
+        elif type_check is not None and not type_check(value):
+            messages.append('must be of {0} type'.format(type_name))
+        elif check_dict is not None:
+            errors = check_dict(value)
+            if errors:
+                messages.append(errors)
+        elif check_item is not None:
+            errors = {}
+            for i, item in enumerate(value):
+                item_errors = check_item(item)
+                if item_errors:
+                    errors[i] = item_errors
+            if errors:
+                messages.append(errors)
+        return messages + coerce_messages if coerce_last else coerce_messages + messages
+
+    check.required = required
+    return check
+
+def compile_schema(schema, coerce_last=False):
+    """Turn a cerberus schema dict into a function returning the errors dict of a document"""
+    checks = [(name, compile_field(name, rules, coerce_last)) for name, rules in schema.iteritems()]
+    known = set(schema)
+
+    def check(document):
+        errors = {}
+        for name, field_check in checks:
+            if name in document:
+                messages = field_check(document[name])
+                if messages:
+                    errors[name] = messages
+            elif field_check.required:
+                errors[name] = ['required field']
+        for name in document:
+            if name not in known:
+                errors[name] = ['unknown field']
+        return errors
+
+    return check
+
+
+class FastValidator(object):
+    """Drop-in for cerberus.Validator that runs checks compiled from the schema
+
+    With first_k, only the first first_k elements of each type are checked;
+    with sample, every round(1 / sample)-th element of each type is checked after that.
+    """
+
+    def __init__(self, schema=SCHEMA, sample=None, first_k=None):
+        self.schema = schema
+        self.check = compile_schema(schema)
+        self.first_k = first_k
+        self.stride = int(round(1 / sample)) if sample else None
+        self.counts = defaultdict(int)
+        self.checked = 0
+        self.errors = {}
+
+    def wanted(self, document):
+        if self.first_k is None and self.stride is None:
+            return True
+        element_type = 'node' if 'node' in document else 'way' if 'way' in document else 'relation'
+        count = self.counts[element_type]
+        self.counts[element_type] = count + 1
+        if self.first_k is not None and count < self.first_k:
+            return True
+        if self.stride is not None:
+            return (count - (self.first_k or 0)) % self.stride == 0
+        return False
+
+    def validate(self, document, schema=None):
+        if schema is not None and schema is not self.schema:
+            self.schema = schema
+            self.check = compile_schema(schema)
+        self.errors = {}
+        if not self.wanted(document):
+            return True
+        self.checked += 1
+        self.errors = self.check(document)
+        return not self.errors
+
+
 class UnicodeDictWriter(csv.DictWriter, object):
     """Extend csv.DictWriter to handle Unicode input"""
 
@@ -455,48 +1160,664 @@ class UnicodeDictWriter(csv.DictWriter, object):
             self.writerow(row)
 
 
+class CsvSink(object):
+    """Write shaped node, way and relation dicts to the csv files"""
+
+    def __init__(self, append=False, prefix=''):
+        #with append the files are kept, for resume() to cut back to a checkpoint
+        mode = 'r+' if append else 'w'
+        self.append = append
+        self.files = [codecs.open(prefix + path, mode) for path in (
+            NODES_PATH, NODE_TAGS_PATH, WAYS_PATH, WAY_NODES_PATH, WAY_TAGS_PATH, RELATIONS_PATH,
+            RELATION_MEMBERS_PATH, RELATION_TAGS_PATH)]
+        (nodes_file, nodes_tags_file, ways_file, way_nodes_file, way_tags_file,
+         relations_file, relation_members_file, relation_tags_file) = self.files
+
+        self.nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
+        self.node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
+        self.ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
+        self.way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
+        self.way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
+        self.relations_writer = UnicodeDictWriter(relations_file, RELATION_FIELDS)
+        self.relation_members_writer = UnicodeDictWriter(relation_members_file, RELATION_MEMBERS_FIELDS)
+        self.relation_tags_writer = UnicodeDictWriter(relation_tags_file, RELATION_TAGS_FIELDS)
+
+        if append:
+            return
+        self.nodes_writer.writeheader()
+        self.node_tags_writer.writeheader()
+        self.ways_writer.writeheader()
+        self.way_nodes_writer.writeheader()
+        self.way_tags_writer.writeheader()
+        self.relations_writer.writeheader()
+        self.relation_members_writer.writeheader()
+        self.relation_tags_writer.writeheader()
+
+    def write(self, el):
+        if 'node' in el:
+            self.nodes_writer.writerow(el['node'])
+            self.node_tags_writer.writerows(el['node_tags'])
+        elif 'way' in el:
+            self.ways_writer.writerow(el['way'])
+            self.way_nodes_writer.writerows(el['way_nodes'])
+            self.way_tags_writer.writerows(el['way_tags'])
+        elif 'relation' in el:
+            self.relations_writer.writerow(el['relation'])
+            self.relation_members_writer.writerows(el['relation_members'])
+            self.relation_tags_writer.writerows(el['relation_tags'])
+
+    def checkpoint(self):
+        """Flush the files and return their sizes"""
+        for f in self.files:
+            f.flush()
+        return {'offsets': [f.tell() for f in self.files]}
+
+    def resume(self, state):
+        """Cut the files back to the sizes recorded at a checkpoint"""
+        if not self.append:
+            raise ValueError('the csv files were emptied when the sink was opened, use CsvSink(append=True) to resume')
+        for f, offset in zip(self.files, state['offsets']):
+            f.seek(offset)
+            f.truncate()
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+    #rows after the last checkpoint are cut off by resume()
+    abort = close
+
+
+class Quarantine(object):
+    """Write elements that fail shaping or validation to a file, one JSON record per line"""
+
+    def __init__(self, path, append=False):
+        #with append the earlier records are kept, for resume() to cut back to a checkpoint
+        self.file = open(path, 'a' if append else 'w')
+        self.count = 0
+
+    def add(self, element, error):
+        if isinstance(element, dict):
+            record = {'element': element}
+        else:
+            record = {'tag': element.tag, 'attrib': dict(element.attrib)}
+        record['error'] = unicode(error)
+        self.file.write(json.dumps(record) + '\n')
+        self.count += 1
+        instruments.count('quarantined')
+
+    def checkpoint(self):
+        self.file.flush()
+        return self.file.tell()
+
+    def resume(self, offset):
+        self.file.seek(offset)
+        self.file.truncate()
+
+    def close(self):
+        self.file.close()
+
+
+class ElementCounter(object):
+    """Pass elements through, counting them and remembering the id of the last one"""
+
+    def __init__(self, elements, count=0):
+        self.elements = elements
+        self.count = count
+        self.last_id = None
+
+    def __iter__(self):
+        for element in self.elements:
+            self.count += 1
+            self.last_id = element.attrib['id']
+            yield element
+
+
+def skip_elements(elements, count, last_id):
+    """Skip the first count elements, checking the last one skipped is the one in the checkpoint"""
+    skipped = None
+    for i, element in enumerate(elements):
+        if i < count:
+            skipped = element.attrib['id']
+            continue
+        if i == count and skipped != last_id:
+            raise ValueError('checkpoint does not match the file: element {0} is {1}, not {2}'.format(
+                count, skipped, last_id))
+        yield element
+
+
+def shape_or_quarantine(elements, quarantine):
+    for element in elements:
+        try:
+            yield shape_element(element)
+        except Exception as error:
+            quarantine.add(element, error)
+            yield None
+
+
+def write_checkpoint(path, state):
+    #write a new file and swap it in, so a crash while writing leaves the last checkpoint intact
+    with open(path + '.tmp', 'w') as fout:
+        json.dump(state, fout)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(path + '.tmp', path)
+
+
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
-def process_map(file_in, validate):
-    """Iteratively process each XML element and write to csv(s)"""
-
-    with codecs.open(NODES_PATH, 'w') as nodes_file,          codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file,          codecs.open(WAYS_PATH, 'w') as ways_file,          codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file,          codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file:
-
-        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
-
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
-
-        validator = cerberus.Validator()
-
-        for element in get_element(file_in, tags=('node', 'way')):
-            el = shape_element(element)
+def process_map(file_in, validate, sink=None, validator=None, batch_size=None, parser='etree',
+                tags=('node', 'way', 'relation'), resume=False, checkpoint_every=None, checkpoint_path=None,
+                quarantine_path=None, report_path=None, integrity=None, parser_options=None):
+    """Iteratively process each XML element and write to csv(s)
+
+    Every checkpoint_every elements the sink is flushed and the position is
+    saved to checkpoint_path, and resume=True carries on from there. With
+    quarantine_path, elements that fail shaping or validation are written
+    to that file instead of stopping the run. When instruments are enabled,
+    their report is written to report_path. integrity is an IntegrityChecker
+    that every element goes through before validation (see In[35]).
+    parser_options are passed to the parser, e.g. {'workers': 4} for 'pbf'.
+    """
+
+    if checkpoint_path is None:
+        checkpoint_path = os.path.basename(file_in) + '.checkpoint.json'
+    state = None
+    if resume and os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as fin:
+            state = json.load(fin)
+
+    if sink is None:
+        sink = CsvSink(append=state is not None)
+    if validator is None:
+        validator = FastValidator(SCHEMA)
+    if state is not None:
+        #fails when the sink was opened in a mode that threw away what the checkpoint covers
+        sink.resume(state['sink'])
+    if checkpoint_every and hasattr(sink, 'start_checkpoints'):
+        sink.start_checkpoints()
+    quarantine = Quarantine(quarantine_path, append=state is not None) if quarantine_path else None
+    if integrity is not None and integrity.action == 'quarantine' and quarantine is None:
+        raise ValueError('IntegrityChecker(action=\'quarantine\') needs a quarantine_path')
+    integrity_path = checkpoint_path + '.integrity.npz'
+
+    timing = instruments.enabled
+    if timing:
+        instruments.begin()
+    elements = get_parser(parser)(file_in, tags=tags, **(parser_options or {}))
+    if timing:
+        elements = instruments.timed('parse', elements)
+    if state is not None:
+        if quarantine is not None:
+            quarantine.resume(state.get('quarantine', 0))
+        if integrity is not None and state.get('integrity'):
+            integrity.resume(state['integrity'])
+        elements = skip_elements(elements, state['elements'], state['last_id'])
+    elements = ElementCounter(elements, state['elements'] if state is not None else 0)
+
+    if batch_size:
+        shaped = shape_columnar(elements, batch_size, quarantine)
+    elif quarantine is not None:
+        shaped = shape_or_quarantine(elements, quarantine)
+    else:
+        shaped = (shape_element(element) for element in elements)
+    if timing:
+        shaped = instruments.timed('shape', shaped)
+
+    done = elements.count
+    checkpointed = done
+    try:
+        for el in shaped:
+            done += 1
+            if el and integrity is not None:
+                if timing:
+                    instruments.start('integrity')
+                el = integrity.check(el, quarantine)
+                if timing:
+                    instruments.stop()
             if el:
-                if validate is True:
-                    validate_element(el, validator)
-
-                if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
-
-
-    print code_list
-process_map(OSM_FILE, validate=True)
-
-
-# Once the .csv files were written, I imported them into a sql database using sqlite3. I chose to use python to specify the data types and include the program in the same workflow. The processed used to create the database files and tables is shown below. It was repeated for each of the five tables.
+                if timing:
+                    instruments.element(el)
+                    instruments.start('validate')
+                valid = True
+                try:
+                    if validate is True:
+                        validate_element(el, validator)
+                except Exception as error:
+                    if quarantine is None:
+                        raise
+                    quarantine.add(el, error)
+                    valid = False
+                if timing:
+                    instruments.stop()
+                if valid:
+                    if timing:
+                        instruments.start('write')
+                    sink.write(el)
+                    if timing:
+                        instruments.stop()
+            #only when every element read so far has been written (shape_columnar reads a batch ahead)
+            if checkpoint_every and done - checkpointed >= checkpoint_every and done == elements.count:
+                if timing:
+                    instruments.start('checkpoint')
+                write_checkpoint(checkpoint_path, {
+                    'file': file_in, 'elements': done, 'last_id': elements.last_id, 'sink': sink.checkpoint(),
+                    'quarantine': quarantine.checkpoint() if quarantine is not None else 0,
+                    'integrity': integrity.checkpoint(integrity_path) if integrity is not None else None})
+                if timing:
+                    instruments.stop()
+                checkpointed = done
+    except:
+        #leave the output as it was at the last checkpoint
+        sink.abort()
+        raise
+    else:
+        if timing:
+            instruments.start('close')
+        sink.close()
+        if timing:
+            instruments.stop()
+    finally:
+        if timing:
+            instruments.end()
+        if quarantine is not None:
+            quarantine.close()
+
+    if timing and report_path:
+        instruments.write_report(report_path)
+
+    #the run finished, a rerun with resume=True starts over
+    if checkpoint_every and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    if os.path.exists(integrity_path):
+        os.remove(integrity_path)
+process_map(OSM_FILE, validate=True, checkpoint_every=100000, quarantine_path='quarantine.jsonl')
+
+
+# Running process_map over the full file keeps a single core busy for a long time, most of it in parsing, shape_element and the validation. The parallel version below splits the file into byte ranges of about range_bytes each, cut at the start of a node, way or relation, so every worker reads and parses its own part of the file. Each worker shapes (and cleans) and validates the elements of its range and writes them to .csv part files of its own. The parts are then joined in file order, without their header lines, so the csv files come out byte-identical to the serial run. Each worker returns the invalid postcodes, cities and street names it found so they can be merged back into the reference sets.
+
+# In[320]:
+
+import multiprocessing
+from cStringIO import StringIO
+
+#start of a top level element; nodes, ways and relations are never nested in an .osm file
+ELEMENT_START = re.compile(r'<(?:node|way|relation)[\s/>]')
+
+def find_element_start(f, offset, window=2 ** 20):
+    """Byte offset of the first node, way or relation starting at or after offset, or None"""
+    while True:
+        f.seek(offset)
+        data = f.read(window + 64)
+        if not data:
+            return None
+        match = ELEMENT_START.search(data)
+        if match is not None and match.start() < window:
+            return offset + match.start()
+        offset += window
+
+
+def osm_byte_ranges(osm_file, range_bytes):
+    """(start, end) byte ranges covering every element of osm_file, each starting at an element"""
+    size = os.path.getsize(osm_file)
+    with open(osm_file, 'rb') as f:
+        f.seek(max(0, size - 4096))
+        tail = f.read()
+        end = size - len(tail) + tail.rfind('</osm>')
+        starts = []
+        for offset in range(0, end, range_bytes):
+            start = find_element_start(f, offset)
+            if start is not None and start < end and (not starts or start > starts[-1]):
+                starts.append(start)
+    return zip(starts, starts[1:] + [end])
+
+
+def get_element_range(osm_file, start, end, tags=('node', 'way', 'relation')):
+    """get_element for the elements between two byte offsets found by osm_byte_ranges"""
+    with open(osm_file, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    for element in get_element(StringIO('<osm>' + data + '</osm>'), tags=tags):
+        yield element
+
+
+def part_prefix(index):
+    return 'part{0:04d}.'.format(index)
+
+
+def process_range(args):
+    """Shape (and optionally validate) the elements of one byte range into .csv part files"""
+    osm_file, start, end, validate, index = args
+    validator = FastValidator(SCHEMA)
+    sink = CsvSink(prefix=part_prefix(index))
+    for element in get_element_range(osm_file, start, end):
+        el = shape_element(element)
+        if el:
+            if validate is True:
+                validate_element(el, validator)
+            sink.write(el)
+    sink.close()
+
+    #hand back what this range added to the reference sets, then reset them for the next one
+    found = (set(code_list), set(other_cities), dict(street_types))
+    code_list.clear()
+    other_cities.clear()
+    street_types.clear()
+    return found
+
+
+def join_parts(paths, out_path):
+    """Concatenate csv part files into out_path, keeping only the header of the first"""
+    with open(out_path, 'wb') as fout:
+        for i, path in enumerate(paths):
+            with open(path, 'rb') as fin:
+                if i > 0:
+                    fin.readline()
+                shutil.copyfileobj(fin, fout)
+
+
+def process_map_parallel(file_in, validate, workers=None, range_bytes=2 ** 24):
+    """Process byte ranges of the XML file with a pool of workers and write the csv(s) in file order"""
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    ranges = osm_byte_ranges(file_in, range_bytes)
+    jobs = [(file_in, start, end, validate, i) for i, (start, end) in enumerate(ranges)]
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        for codes, cities, streets in pool.imap(process_range, jobs):
+            code_list.update(codes)
+            other_cities.update(cities)
+            for street_type, names in streets.iteritems():
+                street_types[street_type].update(names)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    for path in (NODES_PATH, NODE_TAGS_PATH, WAYS_PATH, WAY_NODES_PATH, WAY_TAGS_PATH, RELATIONS_PATH,
+                 RELATION_MEMBERS_PATH, RELATION_TAGS_PATH):
+        parts = [part_prefix(i) + path for i in range(len(jobs))]
+        join_parts(parts, path)
+        for part in parts:
+            os.remove(part)
+    return len(jobs)
+
+
+# The same Montpellier extract is also published as .osm.pbf, the binary OpenStreetMap format, which is several times smaller than the XML and much quicker to decode. get_element_pbf reads it with a small protobuf decoder written with zlib and struct only. It yields the same kind of RawElement records as the expat parser, so shape_element, the cleaners and the writers don't change and the tables come out identical to an XML run. PBF files are split into independently compressed blocks, so with workers > 1 the blocks are decoded by a pool of processes (results are still used in file order). process_map passes parser_options on to the parser, which is how the number of workers gets there.
+# 
+# process_map('Montpellier.osm.pbf', validate=False, parser='pbf')
+# process_map('Montpellier.osm.pbf', validate=False, parser='pbf', parser_options={'workers': 4})
+
+# In[321]:
+
+import struct
+import time
+import zlib
+
+def pbf_varint(data, pos):
+    """Decode the varint starting at pos, return (value, position after it)"""
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+def pbf_signed(value):
+    #int32/int64 fields store negative numbers as 64 bit two's complement
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def pbf_zigzag(value):
+    #sint32/sint64 fields
+    return (value >> 1) ^ -(value & 1)
+
+def pbf_fields(data):
+    """Yield (field number, value) for each field of a protobuf message held in a bytearray"""
+    pos, end = 0, len(data)
+    while pos < end:
+        key, pos = pbf_varint(data, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = pbf_varint(data, pos)
+        elif wire_type == 2:
+            length, pos = pbf_varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        elif wire_type == 1:
+            value = data[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            value = data[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type {0}".format(wire_type))
+        yield key >> 3, value
+
+def pbf_packed(data, decode=None):
+    values = []
+    pos, end = 0, len(data)
+    while pos < end:
+        value, pos = pbf_varint(data, pos)
+        values.append(decode(value) if decode else value)
+    return values
+
+def pbf_delta(values):
+    total = 0
+    decoded = []
+    for value in values:
+        total += value
+        decoded.append(total)
+    return decoded
+
+def pbf_coordinate(nanodegrees):
+    """Format a coordinate the way the .osm files write it (up to 7 decimals, no trailing zeros)"""
+    sign = '-' if nanodegrees < 0 else ''
+    whole, fraction = divmod(abs(nanodegrees), 10 ** 9)
+    fraction = ('%09d' % fraction)[:7].rstrip('0')
+    return sign + str(whole) + ('.' + fraction if fraction else '')
+
+def pbf_timestamp(milliseconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(milliseconds // 1000))
+
+
+def pbf_blobs(osm_file):
+    """Yield (blob type, blob bytes) for each block of a .osm.pbf file"""
+    with open(osm_file, 'rb') as f:
+        while True:
+            size = f.read(4)
+            if len(size) < 4:
+                break
+            header = dict(pbf_fields(bytearray(f.read(struct.unpack('>I', size)[0]))))
+            yield str(header[1]), f.read(header[3])
+
+def pbf_blob_data(blob):
+    fields = dict(pbf_fields(bytearray(blob)))
+    if 1 in fields:
+        return fields[1]
+    if 3 in fields:
+        return bytearray(zlib.decompress(str(fields[3])))
+    raise ValueError("Only raw and zlib compressed PBF blocks are supported")
+
+
+def decode_pbf_block(args):
+    """Decode one OSMData blob into (tag, attrib, children) tuples for the element types in tags"""
+    blob, tags = args
+    strings, groups = [], []
+    granularity, date_granularity, lat_offset, lon_offset = 100, 1000, 0, 0
+    for field, value in pbf_fields(pbf_blob_data(blob)):
+        if field == 1:
+            strings = [str(s).decode('utf-8') for f, s in pbf_fields(value) if f == 1]
+        elif field == 2:
+            groups.append(value)
+        elif field == 17:
+            granularity = value
+        elif field == 18:
+            date_granularity = value
+        elif field == 19:
+            lat_offset = pbf_signed(value)
+        elif field == 20:
+            lon_offset = pbf_signed(value)
+
+    def info_attrib(data):
+        attrib = {}
+        for field, value in pbf_fields(data):
+            if field == 1:
+                attrib['version'] = str(value)
+            elif field == 2:
+                attrib['timestamp'] = pbf_timestamp(pbf_signed(value) * date_granularity)
+            elif field == 3:
+                attrib['changeset'] = str(pbf_signed(value))
+            elif field == 4:
+                attrib['uid'] = str(pbf_signed(value))
+            elif field == 5:
+                attrib['user'] = strings[value]
+        return attrib
+
+    def tag_children(keys, values):
+        return [('tag', {'k': strings[k], 'v': strings[v]}) for k, v in zip(keys, values)]
+
+    def coordinates(attrib, lat, lon):
+        attrib['lat'] = pbf_coordinate(lat_offset + granularity * lat)
+        attrib['lon'] = pbf_coordinate(lon_offset + granularity * lon)
+
+    elements = []
+    for group in groups:
+        for field, data in pbf_fields(group):
+            if field == 1 and 'node' in tags:
+                fields = list(pbf_fields(data))
+                attrib, keys, values, lat, lon = {}, [], [], 0, 0
+                for f, value in fields:
+                    if f == 1:
+                        attrib['id'] = str(pbf_zigzag(value))
+                    elif f == 2:
+                        keys = pbf_packed(value)
+                    elif f == 3:
+                        values = pbf_packed(value)
+                    elif f == 4:
+                        attrib.update(info_attrib(value))
+                    elif f == 8:
+                        lat = pbf_zigzag(value)
+                    elif f == 9:
+                        lon = pbf_zigzag(value)
+                coordinates(attrib, lat, lon)
+                elements.append(('node', attrib, tag_children(keys, values)))
+
+            elif field == 2 and 'node' in tags:
+                dense = dict(pbf_fields(data))
+                ids = pbf_delta(pbf_packed(dense.get(1, bytearray()), pbf_zigzag))
+                lats = pbf_delta(pbf_packed(dense.get(8, bytearray()), pbf_zigzag))
+                lons = pbf_delta(pbf_packed(dense.get(9, bytearray()), pbf_zigzag))
+                keys_vals = pbf_packed(dense.get(10, bytearray()))
+                info = dict(pbf_fields(dense[5])) if 5 in dense else {}
+                versions = pbf_packed(info.get(1, bytearray()))
+                timestamps = pbf_delta(pbf_packed(info.get(2, bytearray()), pbf_zigzag))
+                changesets = pbf_delta(pbf_packed(info.get(3, bytearray()), pbf_zigzag))
+                uids = pbf_delta(pbf_packed(info.get(4, bytearray()), pbf_zigzag))
+                user_sids = pbf_delta(pbf_packed(info.get(5, bytearray()), pbf_zigzag))
+
+                kv = 0
+                for i, node_id in enumerate(ids):
+                    attrib = {'id': str(node_id)}
+                    coordinates(attrib, lats[i], lons[i])
+                    if versions:
+                        attrib['version'] = str(versions[i])
+                        attrib['timestamp'] = pbf_timestamp(timestamps[i] * date_granularity)
+                        attrib['changeset'] = str(changesets[i])
+                        attrib['uid'] = str(uids[i])
+                        attrib['user'] = strings[user_sids[i]]
+                    children = []
+                    #keys_vals holds key, value, key, value, ... 0 for each node
+                    while kv < len(keys_vals) and keys_vals[kv] != 0:
+                        children.append(('tag', {'k': strings[keys_vals[kv]], 'v': strings[keys_vals[kv + 1]]}))
+                        kv += 2
+                    kv += 1
+                    elements.append(('node', attrib, children))
+
+            elif field == 3 and 'way' in tags:
+                attrib, keys, values, refs = {}, [], [], []
+                for f, value in pbf_fields(data):
+                    if f == 1:
+                        attrib['id'] = str(value)
+                    elif f == 2:
+                        keys = pbf_packed(value)
+                    elif f == 3:
+                        values = pbf_packed(value)
+                    elif f == 4:
+                        attrib.update(info_attrib(value))
+                    elif f == 8:
+                        refs = pbf_delta(pbf_packed(value, pbf_zigzag))
+                elements.append(('way', attrib, tag_children(keys, values) +
+                                 [('nd', {'ref': str(ref)}) for ref in refs]))
+
+            elif field == 4 and 'relation' in tags:
+                attrib, keys, values, roles, member_ids, types = {}, [], [], [], [], []
+                for f, value in pbf_fields(data):
+                    if f == 1:
+                        attrib['id'] = str(value)
+                    elif f == 2:
+                        keys = pbf_packed(value)
+                    elif f == 3:
+                        values = pbf_packed(value)
+                    elif f == 4:
+                        attrib.update(info_attrib(value))
+                    elif f == 8:
+                        roles = pbf_packed(value, pbf_signed)
+                    elif f == 9:
+                        member_ids = pbf_delta(pbf_packed(value, pbf_zigzag))
+                    elif f == 10:
+                        types = pbf_packed(value)
+                members = [('member', {'type': ('node', 'way', 'relation')[member_type], 'ref': str(ref),
+                                       'role': strings[role]})
+                           for member_type, ref, role in zip(types, member_ids, roles)]
+                elements.append(('relation', attrib, members + tag_children(keys, values)))
+    return elements
+
+
+def get_element_pbf(osm_file, tags=('node', 'way', 'relation'), workers=1):
+    """Yield a RawElement for each element of the right type in a .osm.pbf file"""
+
+    def records(decoded):
+        for tag, attrib, children in decoded:
+            element = RawElement(tag, attrib)
+            element.children = [RawElement(child_tag, child_attrib) for child_tag, child_attrib in children]
+            yield element
+
+    blocks = ((blob, tags) for blob_type, blob in pbf_blobs(osm_file) if blob_type == 'OSMData')
+    if workers <= 1:
+        for block in blocks:
+            for element in records(decode_pbf_block(block)):
+                yield element
+        return
+
+    pool = multiprocessing.Pool(workers)
+    pending = deque()
+    try:
+        for block in blocks:
+            pending.append(pool.apply_async(decode_pbf_block, (block,)))
+            if len(pending) >= 2 * workers:
+                for element in records(pending.popleft().get()):
+                    yield element
+        while pending:
+            for element in records(pending.popleft().get()):
+                yield element
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+PARSERS['pbf'] = get_element_pbf
+
+
+# Once the .csv files were written, I imported them into a sql database using sqlite3. I chose to use python to specify the data types and include the program in the same workflow. The processed used to create the database files and tables was first repeated by hand for each of the five tables; it is now done for all the tables at once by upload_all_to_sql, further below with the other database code.
 # 
 # Final database files:
 # 
@@ -520,40 +1841,1852 @@ from pprint import pprint
 sqlite_file_m= "montpellier.db"
     # name of the sqlite database file
 
-def upload_to_sql(file_path,sqlite_file):
-    # Connect to the database
+def bump_user_version(conn):
+    """Mark the database as changed by a load, so cached query results are not reused"""
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    conn.execute('PRAGMA user_version = {0}'.format(version + 1))
+
+
+# Writing the .csv files and then reading them back in means every row is serialized and parsed twice. SqliteSink can be handed to process_map instead of the default CsvSink to stream the shaped elements straight into the tables of montpellier.db. Rows are inserted in batches of batch_size elements, one transaction per batch, with pragmas set for a bulk load. Indexes are only created once everything is loaded.
+# 
+# process_map(OSM_FILE, validate=False, sink=SqliteSink(sqlite_file_m, batch_size=20000))
+# 
+# With checkpoint_every set, the sink only commits at the checkpoints, so rows written after the last one are rolled back if the run stops. To resume, open the database without dropping the tables:
+# 
+# process_map(OSM_FILE, validate=False, sink=SqliteSink(sqlite_file_m, replace=False), resume=True, checkpoint_every=100000)
+
+# In[21]:
+
+#table name, csv fields and key in the shaped element for each table
+SQL_TABLES = [('nodes', NODE_FIELDS, 'node'),
+              ('node_tags', NODE_TAGS_FIELDS, 'node_tags'),
+              ('ways', WAY_FIELDS, 'way'),
+              ('way_nodes', WAY_NODES_FIELDS, 'way_nodes'),
+              ('ways_tags', WAY_TAGS_FIELDS, 'way_tags'),
+              ('relations', RELATION_FIELDS, 'relation'),
+              ('relation_members', RELATION_MEMBERS_FIELDS, 'relation_members'),
+              ('relation_tags', RELATION_TAGS_FIELDS, 'relation_tags')]
+
+#sql types for the columns, anything else is stored as TEXT
+SQL_TYPES = {'id': 'INTEGER', 'lat': 'REAL', 'lon': 'REAL', 'uid': 'INTEGER', 'version': 'INTEGER',
+             'changeset': 'INTEGER', 'node_id': 'INTEGER', 'member_id': 'INTEGER', 'position': 'INTEGER'}
+
+SQL_INDEXES = ['CREATE INDEX IF NOT EXISTS node_tags_id ON node_tags(id)',
+               'CREATE INDEX IF NOT EXISTS node_tags_key ON node_tags(key, value)',
+               'CREATE INDEX IF NOT EXISTS way_nodes_id ON way_nodes(id, position)',
+               'CREATE INDEX IF NOT EXISTS way_nodes_node_id ON way_nodes(node_id)',
+               'CREATE INDEX IF NOT EXISTS ways_tags_id ON ways_tags(id)',
+               'CREATE INDEX IF NOT EXISTS ways_tags_key ON ways_tags(key, value)',
+               'CREATE INDEX IF NOT EXISTS relation_members_id ON relation_members(id, position)',
+               'CREATE INDEX IF NOT EXISTS relation_members_member_id ON relation_members(member_id)',
+               'CREATE INDEX IF NOT EXISTS relation_tags_id ON relation_tags(id)',
+               'CREATE INDEX IF NOT EXISTS relation_tags_key ON relation_tags(key, value)']
+
+BULK_LOAD_PRAGMAS = {'journal_mode': 'WAL', 'synchronous': 'OFF', 'cache_size': -200000, 'temp_store': 'MEMORY'}
+
+
+def create_table_sql(table, fields):
+    """CREATE TABLE statement for one of the SQL_TABLES"""
+    columns = []
+    for field in fields:
+        column_type = SQL_TYPES.get(field, 'TEXT')
+        #nodes, ways and relations are keyed by their id, the other tables have several rows per id
+        if field == 'id' and table in ('nodes', 'ways', 'relations'):
+            column_type = 'INTEGER PRIMARY KEY'
+        columns.append('{0} {1}'.format(field, column_type))
+    return 'CREATE TABLE IF NOT EXISTS {0} ({1})'.format(table, ', '.join(columns))
+
+def insert_sql(table, fields):
+    return 'INSERT INTO {0}({1}) VALUES ({2})'.format(table, ', '.join(fields), ', '.join('?' * len(fields)))
+
+SQL_INSERTS = dict((table, insert_sql(table, fields)) for table, fields, _ in SQL_TABLES)
+
+def table_rows(el):
+    """Yield (table, rows) for the parts of a shaped element, rows as tuples in column order"""
+    for table, fields, key in SQL_TABLES:
+        if key in el:
+            value = el[key]
+            if isinstance(value, dict):
+                yield table, [tuple(value[f] for f in fields)]
+            else:
+                yield table, [tuple(row[f] for f in fields) for row in value]
+
+
+class SqliteSink(object):
+    """Stream shaped elements into the tables of an sqlite database in batched transactions"""
+
+    def __init__(self, sqlite_file=sqlite_file_m, batch_size=10000, pragmas=BULK_LOAD_PRAGMAS, replace=True,
+                 spatial_index=False, intern=False, address_index=False, way_geometry=False):
+        self.conn = sqlite3.connect(sqlite_file)
+        self.batch_size = batch_size
+        self.spatial_index = spatial_index
+        self.way_geometry = way_geometry
+        self.address_index = address_index
+        self.replace = replace
+        for name, value in pragmas.iteritems():
+            self.conn.execute('PRAGMA {0} = {1}'.format(name, value))
+
+        #with intern, rows go straight to the _data tables behind the views (see In[32])
+        self.inserts = dict(SQL_INSERTS)
+        self.fields = dict((table, fields) for table, fields, _ in SQL_TABLES)
+        if replace:
+            for field, dictionary in INTERN_TABLES.iteritems():
+                self.conn.execute('DROP TABLE IF EXISTS {0}'.format(dictionary))
+        for table, fields, _ in SQL_TABLES:
+            if replace:
+                drop_table(self.conn, table)
+            if intern and table in INTERNED_TABLES:
+                for statement in create_interned_sql(table, fields):
+                    self.conn.execute(statement)
+                self.inserts[table] = insert_sql(table + '_data', [column for column, _ in interned_columns(fields)])
+            else:
+                self.conn.execute(create_table_sql(table, fields))
+        create_summaries(self.conn, replace)
+        if address_index:
+            create_address_index(self.conn, replace)
+        self.conn.commit()
+        self.interner = Interner(self.conn) if intern else None
+
+        self.rows = dict((table, []) for table, _, _ in SQL_TABLES)
+        self.addresses = []
+        self.counts = defaultdict(int)
+        self.pending = 0
+        self.commit_batches = True
+
+    def write(self, el):
+        for table, rows in table_rows(el):
+            if self.interner is not None and table in INTERNED_TABLES:
+                rows = [self.interner.row(self.fields[table], row) for row in rows]
+            self.rows[table].extend(rows)
+        summary_counts(el, self.counts)
+        if self.address_index:
+            address = address_row(el)
+            if address is not None:
+                self.addresses.append(address)
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.interner is not None:
+            self.interner.flush(self.conn)
+        for table, rows in self.rows.iteritems():
+            if rows:
+                self.conn.executemany(self.inserts[table], rows)
+                del rows[:]
+        if self.addresses:
+            self.conn.executemany(ADDRESS_INSERT, self.addresses)
+            del self.addresses[:]
+        update_summaries(self.conn, self.counts)
+        if self.commit_batches:
+            bump_user_version(self.conn)
+            self.conn.commit()
+        self.pending = 0
+
+    def start_checkpoints(self):
+        """Only commit at checkpoints, so a run that stops before its first one leaves nothing behind"""
+        self.commit_batches = False
+
+    def checkpoint(self):
+        """Commit what has been written; from the first checkpoint on, batches are only committed here"""
+        self.commit_batches = False
+        self.flush()
+        bump_user_version(self.conn)
+        self.conn.commit()
+        return {}
+
+    def resume(self, state):
+        #rows written after the last checkpoint were never committed, so there is nothing to undo
+        if self.replace:
+            raise ValueError('the tables were dropped when the sink was opened, use SqliteSink(replace=False) to resume')
+
+    def abort(self):
+        """Close without committing the rows written since the last commit"""
+        self.conn.rollback()
+        self.conn.close()
+
+    def close(self):
+        self.flush()
+        bump_user_version(self.conn)
+        for statement in SQL_INDEXES:
+            self.conn.execute(interned_index_sql(statement) if self.interner is not None else statement)
+        if self.spatial_index:
+            build_spatial_index(self.conn)
+        if self.way_geometry:
+            build_way_geometry(self.conn)
+        self.conn.commit()
+        self.conn.close()
+
+
+# The Section 3 queries count contributions per user and tags per key and value with GROUP BY over the whole nodes, ways and node_tags tables, so every run is a full table scan. SqliteSink and apply_osc also keep two summary tables up to date while they write: user_counts holds the number of nodes, ways and relations for each (uid, user), and tag_counts the number of rows for each key and value of node_tags, ways_tags and relation_tags. Counts are collected per batch and added with INSERT OR IGNORE followed by UPDATE num = num + ?, and deleted or replaced elements are subtracted the same way. build_summaries fills the tables from scratch for a database loaded from the .csv files. run_query recognises the Section 3 queries and answers them from the summaries when the database has them.
+
+# In[28]:
+
+import re
+
+#summary table name and the columns it counts by
+SUMMARY_TABLES = [('user_counts', ['element', 'uid', 'user']),
+                  ('tag_counts', ['tag_table', 'key', 'value'])]
+
+SUMMARY_FIELDS = dict(SUMMARY_TABLES)
+
+def create_summary_sql(table, fields):
+    columns = ['{0} {1}'.format(field, SQL_TYPES.get(field, 'TEXT')) for field in fields]
+    return 'CREATE TABLE IF NOT EXISTS {0} ({1}, num INTEGER NOT NULL, PRIMARY KEY ({2}))'.format(
+        table, ', '.join(columns), ', '.join(fields))
+
+
+def create_summaries(conn, replace=False):
+    for table, fields in SUMMARY_TABLES:
+        if replace:
+            conn.execute('DROP TABLE IF EXISTS {0}'.format(table))
+        conn.execute(create_summary_sql(table, fields))
+
+
+def has_summaries(conn):
+    found = conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name IN ({0})".format(
+        ', '.join('?' * len(SUMMARY_TABLES))), [table for table, _ in SUMMARY_TABLES]).fetchone()[0]
+    return found == len(SUMMARY_TABLES)
+
+
+def summary_counts(el, counts, sign=1):
+    """Add the summary rows of a shaped element to counts, keyed by (summary table, row)"""
+    for table, fields, key in SQL_TABLES:
+        if key not in el:
+            continue
+        if key in ('node', 'way', 'relation'):
+            counts['user_counts', (key, int(el[key]['uid']), el[key]['user'])] += sign
+        elif key in TAG_PARTS:
+            for tag in el[key]:
+                counts['tag_counts', (table, tag['key'], tag['value'])] += sign
+
+
+def stored_summary_counts(conn, element, element_id, counts, sign=-1):
+    """Add the summary rows of an element already in the database to counts"""
+    tables = ELEMENT_TABLES[element]
+    for uid, user in conn.execute('SELECT uid, user FROM {0} WHERE id = ?'.format(tables[0][0]), (element_id,)):
+        counts['user_counts', (element, uid, user)] += sign
+    for table, _, key in tables:
+        if key in TAG_PARTS:
+            for tag_key, value in conn.execute('SELECT key, value FROM {0} WHERE id = ?'.format(table),
+                                               (element_id,)):
+                counts['tag_counts', (table, tag_key, value)] += sign
+
+
+def update_summaries(conn, counts):
+    """Add the collected counts to the summary tables and empty counts"""
+    rows = defaultdict(list)
+    for (table, row), num in counts.iteritems():
+        if num:
+            rows[table].append((row, num))
+    for table, changes in rows.iteritems():
+        fields = SUMMARY_FIELDS[table]
+        conn.executemany('INSERT OR IGNORE INTO {0}({1}, num) VALUES ({2}, 0)'.format(
+            table, ', '.join(fields), ', '.join('?' * len(fields))), [row for row, _ in changes])
+        conn.executemany('UPDATE {0} SET num = num + ? WHERE {1}'.format(
+            table, ' AND '.join('{0} = ?'.format(field) for field in fields)),
+            [(num,) + tuple(row) for row, num in changes])
+    counts.clear()
+
+
+def build_summaries(sqlite_file=sqlite_file_m):
+    """Rebuild the summary tables from the element tables"""
     conn = sqlite3.connect(sqlite_file)
+    create_summaries(conn, replace=True)
+    for table, _, key in SQL_TABLES:
+        if key in ('node', 'way', 'relation'):
+            conn.execute("INSERT INTO user_counts SELECT '{0}', uid, user, COUNT(*) FROM {1} "
+                         "GROUP BY uid, user".format(key, table))
+        elif key in TAG_PARTS:
+            conn.execute("INSERT INTO tag_counts SELECT '{0}', key, value, COUNT(*) FROM {0} "
+                         "GROUP BY key, value".format(table))
+    bump_user_version(conn)
+    conn.commit()
+    conn.close()
+
+
+#only the tag tables are counted in tag_counts
+TAG_TABLE_PATTERN = '({0})'.format('|'.join(table for table, _, key in SQL_TABLES if key in TAG_PARTS))
+
+#Section 3 queries (whitespace collapsed) and the summary query answering them, groups become parameters
+SUMMARY_ROUTES = [
+    #UNION keeps one NULL uid, which COUNT(DISTINCT uid) leaves out
+    (re.compile(r'SELECT COUNT\(\*\) FROM \(SELECT uid FROM nodes UNION SELECT uid FROM ways\);?$', re.I),
+     "SELECT COUNT(DISTINCT uid) + EXISTS (SELECT 1 FROM user_counts WHERE element IN ('node', 'way') "
+     "AND num > 0 AND uid IS NULL) FROM user_counts WHERE element IN ('node', 'way') AND num > 0"),
+    (re.compile(r'SELECT user, ?COUNT\(\*\) as num FROM \(SELECT user FROM nodes UNION ALL SELECT user FROM ways\) '
+                r'e GROUP BY e\.user ORDER BY num DESC;?$', re.I),
+     "SELECT user, SUM(num) AS total FROM user_counts WHERE element IN ('node', 'way') "
+     "GROUP BY user HAVING total > 0 ORDER BY total DESC"),
+    (re.compile(r'SELECT key, COUNT\(\*\) FROM ' + TAG_TABLE_PATTERN + r' GROUP BY key ORDER BY COUNT\(\*\) DESC'
+                r'(?: LIMIT (\d+))?;?$', re.I),
+     'SELECT key, SUM(num) AS total FROM tag_counts WHERE tag_table = ? '
+     'GROUP BY key HAVING total > 0 ORDER BY total DESC LIMIT ?'),
+    (re.compile(r'SELECT value, COUNT\(\*\) as num FROM ' + TAG_TABLE_PATTERN +
+                r' WHERE key ?= ?["\']([^"\']*)["\'] GROUP BY value ORDER BY num DESC(?: LIMIT (\d+))?;?$', re.I),
+     'SELECT value, num FROM tag_counts WHERE tag_table = ? AND key = ? AND num > 0 ORDER BY num DESC LIMIT ?')]
+
+def route_query(conn, sql, params=()):
+    """The summary query and parameters answering sql, or sql itself"""
+    if not params and has_summaries(conn):
+        query = ' '.join(sql.split())
+        for pattern, summary in SUMMARY_ROUTES:
+            match = pattern.match(query)
+            if match:
+                #a missing LIMIT is passed as -1, no limit
+                return summary, [-1 if group is None else group for group in match.groups()]
+    return sql, params
+
+
+def run_query(conn, sql, params=()):
+    sql, params = route_query(conn, sql, params)
+    return conn.execute(sql, params).fetchall()
+
+
+# Every Section 3 cell opened its own connection, ran its queries and closed it again, so the same tag and user queries were parsed and run from scratch on each rerun against an unchanged montpellier.db. AnalysisDB keeps a small pool of read-only connections (query_only, with the file memory mapped) with a statement cache for the prepared queries, and keeps the results of recent queries. The results are keyed by the query, its parameters and the user_version of the database, which every writer above bumps when it commits, so a load or an .osc update makes the cached results stale. The loaders put the database in WAL mode (BULK_LOAD_PRAGMAS), which is kept in the file, so these readers don't block a load. Queries go through route_query first, so the Section 3 queries are answered from the summaries.
+
+# In[29]:
+
+import Queue
+import threading
+from contextlib import contextmanager
+
+READ_PRAGMAS = {'query_only': 1, 'mmap_size': 2**28, 'cache_size': -50000, 'temp_store': 'MEMORY'}
+
+class AnalysisDB(object):
+    """Pooled read-only connections to the analysis database with a cache of query results"""
+
+    def __init__(self, sqlite_file=sqlite_file_m, pool_size=4, cache_size=256, cached_statements=200,
+                 pragmas=READ_PRAGMAS):
+        self.sqlite_file = sqlite_file
+        self.cached_statements = cached_statements
+        self.pragmas = pragmas
+        self.pool = Queue.Queue(pool_size)
+        self.results = LRUCache(cache_size)
+        self.lock = threading.Lock()
+
+    def connect(self):
+        conn = sqlite3.connect(self.sqlite_file, check_same_thread=False,
+                               cached_statements=self.cached_statements)
+        for name, value in self.pragmas.iteritems():
+            conn.execute('PRAGMA {0} = {1}'.format(name, value))
+        return conn
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self.pool.get_nowait()
+        except Queue.Empty:
+            conn = self.connect()
+        try:
+            yield conn
+        finally:
+            try:
+                self.pool.put_nowait(conn)
+            except Queue.Full:
+                conn.close()
+
+    def query(self, sql, params=()):
+        """Rows for sql, from the cache when the database hasn't changed since they were read"""
+        with self.connection() as conn:
+            sql, params = route_query(conn, sql, params)
+            generation = conn.execute('PRAGMA user_version').fetchone()[0]
+            key = (sql, tuple(params), generation)
+            with self.lock:
+                rows = self.results.get(key)
+            if rows is _MISSING:
+                rows = conn.execute(sql, params).fetchall()
+                with self.lock:
+                    self.results.put(key, rows)
+        return list(rows)
+
+    def frame(self, sql, params=(), columns=None):
+        return pd.DataFrame(self.query(sql, params), columns=columns)
+
+    def stats(self):
+        return self.results.stats()
+
+    def close(self):
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except Queue.Empty:
+                break
+
+
+#one AnalysisDB per database file, kept across reruns of the cells below
+ANALYSIS_DBS = {}
+
+def get_analysis_db(sqlite_file=sqlite_file_m):
+    if sqlite_file not in ANALYSIS_DBS:
+        ANALYSIS_DBS[sqlite_file] = AnalysisDB(sqlite_file)
+    return ANALYSIS_DBS[sqlite_file]
+
+
+# upload_to_sql loaded one .csv file at a time with its columns written out by hand, read the whole file into memory first, and failed on a rerun because the table already existed. upload_all_to_sql loads every table of SQL_TABLES from its .csv file with the same column types as SqliteSink. Each table is read in chunks of chunk_size rows into a staging database of its own, with the tables loading in parallel in a process pool. The staging databases are then attached to montpellier.db one at a time and copied in with INSERT ... SELECT, replacing the table if it was loaded before. The indexes and the summary tables are built once all the tables are in, and the R*Tree, way_geometry and addresses tables are built again if an earlier load made them. The workers of the pool are separate processes; on Windows they start by importing the script again, which runs every cell at the top level, so the load at the end of Section 2 uses workers=1.
+
+# In[30]:
+
+from itertools import islice
+
+#csv file written by CsvSink for each table
+CSV_PATHS = {'nodes': NODES_PATH, 'node_tags': NODE_TAGS_PATH, 'ways': WAYS_PATH, 'way_nodes': WAY_NODES_PATH,
+             'ways_tags': WAY_TAGS_PATH, 'relations': RELATIONS_PATH, 'relation_members': RELATION_MEMBERS_PATH,
+             'relation_tags': RELATION_TAGS_PATH}
+
+STAGING_PRAGMAS = {'journal_mode': 'OFF', 'synchronous': 'OFF', 'cache_size': -50000}
+
+def load_csv_table(args):
+    """Load one .csv file into its table in a staging database, chunk_size rows at a time"""
+    table, fields, csv_path, staging_file, chunk_size = args
+    conn = sqlite3.connect(staging_file)
     conn.text_factory = str
+    for name, value in STAGING_PRAGMAS.iteritems():
+        conn.execute('PRAGMA {0} = {1}'.format(name, value))
+    conn.execute('DROP TABLE IF EXISTS {0}'.format(table))
+    conn.execute(create_table_sql(table, fields))
+
+    rows = 0
+    with open(csv_path, 'rb') as fin:
+        reader = csv.reader(fin)
+        header = next(reader)
+        columns = [header.index(field) for field in fields]
+        while True:
+            chunk = [tuple(row[i] for i in columns) for row in islice(reader, chunk_size)]
+            if not chunk:
+                break
+            conn.executemany(SQL_INSERTS[table], chunk)
+            rows += len(chunk)
+    conn.commit()
+    conn.close()
+    return table, rows
 
-    # Get a cursor object
-    cur = conn.cursor()
 
-    #cur.execute('DROP TABLE IF EXISTS ways') #drop tables if it already exists when making a new one
-    conn.commit() #commit the changes
+def upload_all_to_sql(sqlite_file=sqlite_file_m, tables=None, workers=None, chunk_size=50000):
+    """Load the .csv files of SQL_TABLES into sqlite_file, returning the rows loaded per table"""
+    jobs = [(table, fields, CSV_PATHS[table], '{0}.{1}.staging'.format(sqlite_file, table), chunk_size)
+            for table, fields, _ in SQL_TABLES
+            if (tables is None or table in tables) and os.path.exists(CSV_PATHS[table])]
 
-    # Read in the csv file as a dictionary, format the
-    # data as a list of tuples:
-    with open(file_path,'rb') as fin:
-        dr = csv.DictReader(fin) # comma is default delimiter
-        to_db = [(i['id'], i['node_id'],i['position']) for i in dr]
+    pool = multiprocessing.Pool(workers) if workers != 1 and len(jobs) > 1 else None
+    try:
+        loaded = (pool.map if pool is not None else map)(load_csv_table, jobs)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
-    # insert the formatted data
-    cur.execute('''CREATE TABLE way_nodes(id INTEGER, node_id INTEGER, position INTEGER)''')
-    cur.executemany("INSERT INTO way_nodes(id, node_id, position) VALUES (?, ?, ?);", to_db)
-    # commit the changes
+    conn = sqlite3.connect(sqlite_file)
+    for name, value in BULK_LOAD_PRAGMAS.iteritems():
+        conn.execute('PRAGMA {0} = {1}'.format(name, value))
+    for table, fields, _ in SQL_TABLES:
+        conn.execute(create_table_sql(table, fields))
+    for table, fields, _, staging_file, _ in jobs:
+        drop_table(conn, table)
+        conn.execute(create_table_sql(table, fields))
+        conn.execute('ATTACH DATABASE ? AS staging', (staging_file,))
+        conn.execute('INSERT INTO main.{0} SELECT * FROM staging.{0}'.format(table))
+        conn.commit()
+        conn.execute('DETACH DATABASE staging')
+        os.remove(staging_file)
+    for statement in SQL_INDEXES:
+        conn.execute(statement)
     conn.commit()
+    conn.close()
+
+    build_summaries(sqlite_file)
+
+    #tables derived from the ones just replaced, left by an earlier load, are built again
+    conn = sqlite3.connect(sqlite_file)
+    if has_spatial_index(conn):
+        build_spatial_index(conn)
+    if has_way_geometry(conn):
+        build_way_geometry(conn)
+    indexed = has_address_index(conn)
+    conn.close()
+    if indexed:
+        build_address_index(sqlite_file)
+    return dict(loaded)
+
+
+# The .csv files keep every value as text, so ids and coordinates are parsed again by every program that reads them, and user names and tag keys are repeated on every row. ParquetSink writes the same tables as compressed Parquet files instead, with typed columns (the SQL_TYPES used for the database) built batch_size elements at a time, and the user, key and type columns dictionary-encoded. Each table is a directory of part files, and a new part is started at every checkpoint of process_map so a resumed run can drop the parts written after it. MultiSink passes the elements to several sinks, to write the .csv files and the Parquet files in the same run. read_parquet_table reads a table back into pandas through a memory map, with the dictionary-encoded columns as categoricals. ParquetSink needs the pyarrow package.
+# 
+# process_map(OSM_FILE, validate=False, sink=MultiSink(CsvSink(), ParquetSink('parquet')))
+# nodes = read_parquet_table('nodes', ['id', 'lat', 'lon', 'user'])
+
+# In[31]:
+
+import glob
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+PARQUET_DICTIONARY_FIELDS = ('user', 'key', 'type')
+
+def arrow_column(field, values):
+    column_type = SQL_TYPES.get(field, 'TEXT')
+    if column_type == 'INTEGER':
+        return pa.array([int(value) for value in values], type=pa.int64())
+    if column_type == 'REAL':
+        return pa.array([float(value) for value in values], type=pa.float64())
+    column = pa.array(values, type=pa.string())
+    return column.dictionary_encode() if field in PARQUET_DICTIONARY_FIELDS else column
+
+
+def parquet_part_path(out_dir, table, part):
+    return os.path.join(out_dir, table, 'part-{0:05d}.parquet'.format(part))
+
+
+class ParquetSink(object):
+    """Write shaped elements to a directory of Parquet files per table, batch_size elements per row group"""
+
+    def __init__(self, out_dir='parquet', batch_size=50000, compression='snappy', append=False):
+        if pa is None:
+            raise ImportError('ParquetSink needs the pyarrow package')
+        self.out_dir = out_dir
+        self.batch_size = batch_size
+        self.compression = compression
+        self.append = append
+        self.schemas = {}
+        for table, fields, _ in SQL_TABLES:
+            columns = [arrow_column(field, []) for field in fields]
+            self.schemas[table] = pa.schema([(field, column.type) for field, column in zip(fields, columns)])
+            if not os.path.isdir(os.path.join(out_dir, table)):
+                os.makedirs(os.path.join(out_dir, table))
+            elif not append:
+                for path in glob.glob(os.path.join(out_dir, table, '*.parquet')):
+                    os.remove(path)
+
+        self.rows = dict((table, []) for table, _, _ in SQL_TABLES)
+        self.writers = {}
+        self.part = 0
+        self.pending = 0
+
+    def write(self, el):
+        for table, rows in table_rows(el):
+            self.rows[table].extend(rows)
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        for table, fields, _ in SQL_TABLES:
+            rows = self.rows[table]
+            if not rows:
+                continue
+            if table not in self.writers:
+                self.writers[table] = pq.ParquetWriter(parquet_part_path(self.out_dir, table, self.part),
+                                                       self.schemas[table], compression=self.compression)
+            columns = [arrow_column(field, values) for field, values in zip(fields, zip(*rows))]
+            self.writers[table].write_table(pa.Table.from_arrays(columns, schema=self.schemas[table]))
+            del rows[:]
+        self.pending = 0
+
+    def checkpoint(self):
+        """Finish the current part files, the next rows go to new ones"""
+        self.close()
+        self.part += 1
+        return {'part': self.part}
+
+    def resume(self, state):
+        """Drop the part files written after the checkpoint"""
+        if not self.append:
+            raise ValueError('the part files were deleted when the sink was opened, use ParquetSink(append=True) to resume')
+        self.part = state['part']
+        for table, _, _ in SQL_TABLES:
+            for path in glob.glob(os.path.join(self.out_dir, table, '*.parquet')):
+                if path >= parquet_part_path(self.out_dir, table, self.part):
+                    os.remove(path)
+
+    def close(self):
+        self.flush()
+        for writer in self.writers.itervalues():
+            writer.close()
+        self.writers = {}
+
+    #a part cut short is dropped by resume()
+    abort = close
+
+
+class MultiSink(object):
+    """Hand every shaped element to each of several sinks"""
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def write(self, el):
+        for sink in self.sinks:
+            sink.write(el)
+
+    def start_checkpoints(self):
+        for sink in self.sinks:
+            if hasattr(sink, 'start_checkpoints'):
+                sink.start_checkpoints()
+
+    def checkpoint(self):
+        return [sink.checkpoint() for sink in self.sinks]
+
+    def resume(self, state):
+        for sink, sink_state in zip(self.sinks, state):
+            sink.resume(sink_state)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+    def abort(self):
+        for sink in self.sinks:
+            sink.abort()
+
+
+def read_parquet_table(table, columns=None, out_dir='parquet'):
+    """Read a table written by ParquetSink into a DataFrame, memory mapping the files"""
+    if pq is None:
+        raise ImportError('read_parquet_table needs the pyarrow package')
+    fields = dict((name, fields) for name, fields, _ in SQL_TABLES)[table]
+    dataset = pq.ParquetDataset(os.path.join(out_dir, table), memory_map=True,
+                                read_dictionary=[field for field in fields if field in PARQUET_DICTIONARY_FIELDS])
+    return dataset.read(columns=columns).to_pandas()
+
+
+# Every tag row stores its key, type and value as text, and every node and way its user name, although a few hundred keys and users make up almost all of the rows. With SqliteSink(intern=True) these strings are stored once, in the dictionary tables users, tag_keys, tag_types and tag_values, and the element and tag tables (renamed nodes_data, node_tags_data, ...) keep the small integer id instead. Tag values are only interned for the keys in INTERNED_VALUE_KEYS, where the same few values repeat (highway=residential, building=yes); other values such as names and addresses stay in the value column. The sink assigns the ids in memory during the load. Views with the old table names and columns join the strings back in, so the queries above and below work unchanged, and INSTEAD OF triggers on the views intern the strings of rows inserted, updated or deleted through them (apply_osc, for example). tag_histogram counts tags by the integer key and value ids when the database is interned.
+
+# In[32]:
+
+#dictionary table for each interned column
+INTERN_TABLES = {'user': 'users', 'key': 'tag_keys', 'type': 'tag_types', 'value': 'tag_values'}
+
+#tag values are only interned for these keys (addresses are left out, reclean_tag_table rewrites them)
+INTERNED_VALUE_KEYS = ('highway', 'building', 'amenity', 'shop', 'cuisine', 'species', 'source', 'landuse',
+                       'natural', 'leisure', 'surface', 'barrier', 'oneway', 'wheelchair', 'type', 'boundary',
+                       'admin_level', 'railway', 'public_transport', 'bus', 'power', 'service', 'access')
+
+INTERNED_TABLES = ('nodes', 'node_tags', 'ways', 'ways_tags', 'relations', 'relation_tags')
+
+def interned_columns(fields):
+    """(column, type) of the _data table storing a table with these fields"""
+    columns = []
+    for field in fields:
+        if field in INTERN_TABLES:
+            columns.append((field + '_id', 'INTEGER'))
+        if field not in INTERN_TABLES or field == 'value':
+            columns.append((field, SQL_TYPES.get(field, 'TEXT')))
+    return columns
+
+
+def create_interned_sql(table, fields):
+    """Statements creating the _data table, the view with the original columns and its triggers"""
+    columns = interned_columns(fields)
+    value_keys = ', '.join("'{0}'".format(key) for key in INTERNED_VALUE_KEYS)
+    statements = ['CREATE TABLE IF NOT EXISTS {0} ({1}_id INTEGER PRIMARY KEY, {1} TEXT UNIQUE)'.format(
+        dictionary, field) for field, dictionary in sorted(INTERN_TABLES.items())]
+    statements.append('CREATE TABLE IF NOT EXISTS {0}_data ({1})'.format(table, ', '.join(
+        '{0} {1}'.format(column, 'INTEGER PRIMARY KEY' if column == 'id' and table in ('nodes', 'ways', 'relations')
+                         else column_type) for column, column_type in columns)))
+
+    select, joins = [], []
+    for field in fields:
+        if field == 'value':
+            select.append('COALESCE({0}.value, t.value) AS value'.format(INTERN_TABLES[field]))
+        elif field in INTERN_TABLES:
+            select.append('{0}.{1} AS {1}'.format(INTERN_TABLES[field], field))
+        else:
+            select.append('t.{0} AS {0}'.format(field))
+        if field in INTERN_TABLES:
+            joins.append('LEFT JOIN {0} ON {0}.{1}_id = t.{1}_id'.format(INTERN_TABLES[field], field))
+    statements.append('CREATE VIEW IF NOT EXISTS {0} AS SELECT {1} FROM {0}_data t {2}'.format(
+        table, ', '.join(select), ' '.join(joins)))
+
+    def interning(row):
+        #statements adding the strings of NEW or OLD to the dictionary tables
+        added = []
+        for field in fields:
+            if field == 'value':
+                added.append('INSERT OR IGNORE INTO tag_values(value) SELECT {0}.value WHERE {0}.key IN ({1});'.format(
+                    row, value_keys))
+            elif field in INTERN_TABLES:
+                added.append('INSERT OR IGNORE INTO {0}({1}) VALUES ({2}.{1});'.format(INTERN_TABLES[field], field, row))
+        return added
+
+    def stored(row):
+        #the values of the _data columns for the row NEW or OLD
+        values = []
+        for field in fields:
+            if field == 'value':
+                values.append('(SELECT value_id FROM tag_values WHERE value = {0}.value AND {0}.key IN ({1}))'.format(
+                    row, value_keys))
+                values.append('CASE WHEN {0}.key IN ({1}) THEN NULL ELSE {0}.value END'.format(row, value_keys))
+            elif field in INTERN_TABLES:
+                values.append('(SELECT {1}_id FROM {0} WHERE {1} = {2}.{1})'.format(INTERN_TABLES[field], field, row))
+            else:
+                values.append('{0}.{1}'.format(row, field))
+        return values
+
+    #one _data row matching OLD (a tag can be stored twice for the same element)
+    old_row = '(SELECT d.rowid FROM {0}_data d WHERE {1} LIMIT 1)'.format(table, ' AND '.join(
+        'd.{0} IS {1}'.format(column, value) for (column, _), value in zip(columns, stored('OLD'))))
+    names = ', '.join(column for column, _ in columns)
+    statements.append('CREATE TRIGGER IF NOT EXISTS {0}_insert INSTEAD OF INSERT ON {0} BEGIN {1} '
+                      'INSERT INTO {0}_data({2}) VALUES ({3}); END'.format(
+                          table, ' '.join(interning('NEW')), names, ', '.join(stored('NEW'))))
+    statements.append('CREATE TRIGGER IF NOT EXISTS {0}_delete INSTEAD OF DELETE ON {0} BEGIN '
+                      'DELETE FROM {0}_data WHERE rowid = {1}; END'.format(table, old_row))
+    statements.append('CREATE TRIGGER IF NOT EXISTS {0}_update INSTEAD OF UPDATE ON {0} BEGIN {1} '
+                      'UPDATE {0}_data SET {2} WHERE rowid = {3}; END'.format(
+                          table, ' '.join(interning('NEW')), ', '.join(
+                              '{0} = {1}'.format(column, value) for (column, _), value in zip(columns, stored('NEW'))),
+                          old_row))
+    return statements
+
+
+def interned_index_sql(statement):
+    """The SQL_INDEXES statement for the _data table of an interned table"""
+    match = re.match(r'(CREATE INDEX IF NOT EXISTS \w+ ON )(\w+)\((.*)\)$', statement)
+    prefix, table, columns = match.groups()
+    if table not in INTERNED_TABLES:
+        return statement
+    columns = [column.strip() for column in columns.split(',')]
+    return '{0}{1}_data({2})'.format(prefix, table, ', '.join(
+        column + '_id' if column in INTERN_TABLES else column for column in columns))
+
+
+def is_interned(conn, table):
+    return conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = ?",
+                        (table + '_data',)).fetchone()[0] == 1
+
+
+def drop_table(conn, table):
+    """Drop a table, or the view and _data table standing for it"""
+    #DROP VIEW IF EXISTS fails when the name is a table, so look up which one it is
+    kind = conn.execute("SELECT type FROM sqlite_master WHERE name = ? AND type IN ('table', 'view')",
+                        (table,)).fetchone()
+    if kind is not None:
+        conn.execute('DROP {0} {1}'.format(kind[0].upper(), table))
+    conn.execute('DROP TABLE IF EXISTS {0}_data'.format(table))
+
+
+class Interner(object):
+    """Integer ids for the strings of the dictionary tables, assigned in memory during a load"""
+
+    def __init__(self, conn):
+        self.ids = {}
+        self.last = {}
+        self.added = {}
+        for field, dictionary in INTERN_TABLES.iteritems():
+            self.ids[field] = dict((name, i) for i, name in conn.execute(
+                'SELECT {0}_id, {0} FROM {1}'.format(field, dictionary)))
+            self.last[field] = max(self.ids[field].itervalues()) if self.ids[field] else 0
+            self.added[field] = []
+        self.value_keys = frozenset(INTERNED_VALUE_KEYS)
+
+    def intern(self, field, name):
+        ids = self.ids[field]
+        i = ids.get(name)
+        if i is None:
+            self.last[field] += 1
+            i = ids[name] = self.last[field]
+            self.added[field].append((i, name))
+        return i
+
+    def row(self, fields, row):
+        """The _data row for a row of the table with these fields"""
+        stored = []
+        for field, value in zip(fields, row):
+            if field == 'value':
+                if row[fields.index('key')] in self.value_keys:
+                    stored.extend((self.intern('value', value), None))
+                else:
+                    stored.extend((None, value))
+            elif field in INTERN_TABLES:
+                stored.append(self.intern(field, value))
+            else:
+                stored.append(value)
+        return tuple(stored)
+
+    def flush(self, conn):
+        """Insert the strings given an id since the last flush"""
+        for field, added in self.added.iteritems():
+            if added:
+                conn.executemany('INSERT INTO {1}({0}_id, {0}) VALUES (?, ?)'.format(field, INTERN_TABLES[field]),
+                                 added)
+                del added[:]
+
+
+def tag_histogram(conn, table='node_tags', key=None, limit=-1):
+    """(key, count) for the keys of a tag table, or (value, count) for the values of one key"""
+    if not is_interned(conn, table):
+        if key is None:
+            return conn.execute('SELECT key, COUNT(*) AS num FROM {0} GROUP BY key ORDER BY num DESC '
+                                'LIMIT ?'.format(table), (limit,)).fetchall()
+        return conn.execute('SELECT value, COUNT(*) AS num FROM {0} WHERE key = ? GROUP BY value ORDER BY num DESC '
+                            'LIMIT ?'.format(table), (key, limit)).fetchall()
+    if key is None:
+        return conn.execute('SELECT tag_keys.key, num FROM (SELECT key_id, COUNT(*) AS num FROM {0}_data '
+                            'GROUP BY key_id ORDER BY num DESC LIMIT ?) t JOIN tag_keys USING (key_id) '
+                            'ORDER BY num DESC'.format(table), (limit,)).fetchall()
+    return conn.execute('SELECT COALESCE(tag_values.value, t.value), num FROM (SELECT value_id, value, COUNT(*) AS num '
+                        'FROM {0}_data WHERE key_id = (SELECT key_id FROM tag_keys WHERE key = ?) '
+                        'GROUP BY value_id, value ORDER BY num DESC LIMIT ?) t '
+                        'LEFT JOIN tag_values USING (value_id) ORDER BY num DESC'.format(table),
+                        (key, limit)).fetchall()
+
+
+# Once the addr:* tags are cleaned, finding an address still meant a LIKE scan over node_tags or ways_tags, joined back to itself to put the street, number and postcode of an element together. With SqliteSink(address_index=True) the loader puts the housenumber, street, postcode and city of every element with an address into one row of the addresses table, an SQLite FTS5 full-text index. It uses the unicode61 tokenizer with remove_diacritics, so "allee" finds "All\xe9e". The rowid of each row encodes the element type and id (see address_rowid), so apply_osc can replace the address of an element it changes. build_address_index builds the table for a database that is already loaded. find_address matches every word of the input as a prefix, and fuzzy_address first replaces the words that aren't in the index by the closest indexed word (difflib), for misspelled input. The indexed words are read once per database and read again only when its user_version changes. This needs an SQLite built with FTS5.
+# 
+# find_address(conn, 'allee des muri')
+# fuzzy_address(conn, '12 avenu d occitani')
+
+# In[33]:
+
+import difflib
+import unicodedata
+
+ADDRESS_FIELDS = ('housenumber', 'street', 'postcode', 'city')
+
+#element type stored in the low bits of an address rowid
+ADDRESS_ELEMENTS = ('node', 'way', 'relation')
 
-    #check data was inserted correctly with right format
-    cur.execute('SELECT COUNT(*) FROM way_nodes')
-    all_rows = cur.fetchall()
-    print all_rows
+def address_rowid(element, element_id):
+    return int(element_id) * 4 + ADDRESS_ELEMENTS.index(element)
 
-    conn.close() #close connection
-    print 'done'
-    return
 
+def create_address_index(conn, replace=False):
+    if replace:
+        conn.execute('DROP TABLE IF EXISTS addresses')
+        conn.execute('DROP TABLE IF EXISTS addresses_vocab')
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS addresses USING fts5({0}, "
+                 "tokenize = 'unicode61 remove_diacritics 2')".format(', '.join(ADDRESS_FIELDS)))
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS addresses_vocab USING fts5vocab(addresses, 'row')")
 
-upload_to_sql(WAY_NODES_PATH,sqlite_file_m)
+
+def has_address_index(conn):
+    return conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'addresses'").fetchone()[0] == 1
+
+
+def address_row(el):
+    """(rowid, housenumber, street, postcode, city) for a shaped element with an address, or None"""
+    for element, part in zip(ADDRESS_ELEMENTS, TAG_PARTS):
+        if part in el:
+            address = dict((tag['key'], tag['value']) for tag in el[part]
+                           if tag['type'] == 'addr' and tag['key'] in ADDRESS_FIELDS)
+            if address:
+                return (address_rowid(element, el[element]['id']),) + tuple(address.get(f) for f in ADDRESS_FIELDS)
+    return None
+
+
+ADDRESS_INSERT = 'INSERT INTO addresses(rowid, {0}) VALUES (?, {1})'.format(
+    ', '.join(ADDRESS_FIELDS), ', '.join('?' * len(ADDRESS_FIELDS)))
+
+def build_address_index(sqlite_file=sqlite_file_m):
+    """Fill the addresses table from the addr tags of the tag tables"""
+    conn = sqlite3.connect(sqlite_file)
+    create_address_index(conn, replace=True)
+    for element, (table, _, _) in zip(ADDRESS_ELEMENTS, [t for t in SQL_TABLES if t[2] in TAG_PARTS]):
+        conn.execute("INSERT INTO addresses(rowid, {0}) SELECT id * 4 + {1}, {2} FROM {3} WHERE type = 'addr' "
+                     "AND key IN ({4}) GROUP BY id".format(
+                         ', '.join(ADDRESS_FIELDS), ADDRESS_ELEMENTS.index(element),
+                         ', '.join("MAX(CASE WHEN key = '{0}' THEN value END)".format(f) for f in ADDRESS_FIELDS),
+                         table, ', '.join("'{0}'".format(f) for f in ADDRESS_FIELDS)))
+    bump_user_version(conn)
+    conn.commit()
+    conn.close()
+
+
+def address_words(text):
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    #the same folding as the tokenizer: no accents, lower case
+    text = u''.join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c))
+    return re.findall(r'\w+', text.lower(), re.UNICODE)
+
+
+def find_address(conn, text, limit=10, words=None):
+    """(element, id, housenumber, street, postcode, city) of the best matches, every word used as a prefix"""
+    words = words or address_words(text)
+    if not words:
+        return []
+    query = ' '.join(u'"{0}"*'.format(word) for word in words)
+    rows = conn.execute('SELECT rowid, {0} FROM addresses WHERE addresses MATCH ? ORDER BY rank LIMIT ?'.format(
+        ', '.join(ADDRESS_FIELDS)), (query, limit)).fetchall()
+    return [(ADDRESS_ELEMENTS[rowid % 4], rowid // 4) + tuple(address) for rowid, address in
+            ((row[0], row[1:]) for row in rows)]
+
+
+#database file -> (user_version, indexed words, the same as a set)
+ADDRESS_VOCAB = {}
+
+def address_vocab(conn):
+    """The words of the address index, read again only when the database has changed"""
+    path = conn.execute('PRAGMA database_list').fetchone()[2]
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    cached = ADDRESS_VOCAB.get(path)
+    if cached is not None and cached[0] == version:
+        return cached[1], cached[2]
+    terms = [term for (term,) in conn.execute('SELECT term FROM addresses_vocab')]
+    #an in-memory database has no file to key it by
+    if path:
+        ADDRESS_VOCAB[path] = (version, terms, set(terms))
+    return terms, set(terms)
+
+
+def fuzzy_address(conn, text, limit=10, cutoff=0.75):
+    """find_address, with the words missing from the index replaced by the closest indexed word"""
+    terms, known = address_vocab(conn)
+    words = []
+    for word in address_words(text):
+        if word not in known and not word.isdigit():
+            close = difflib.get_close_matches(word, terms, 1, cutoff)
+            if close:
+                word = close[0]
+        words.append(word)
+    return find_address(conn, text, limit, words)
+
+
+# Refreshing the data doesn't need a full re-import. OpenStreetMap publishes osmChange (.osc) diffs that list the nodes, ways and relations created, modified or deleted since the extract. apply_osc streams a diff and applies it to the existing tables: created and modified elements go through the same shape_element cleaning and replace any rows already stored for that id, and deleted elements have their rows removed. An edit is skipped as stale when the (version, changeset) already stored for the element is the same or newer. Deleted elements keep their (version, changeset) in the deleted_elements table, so applying an older diff again doesn't bring them back.
+
+# In[22]:
+
+#tables holding the rows for each element type, main table first
+ELEMENT_TABLES = {'node': [t for t in SQL_TABLES if t[2] in ('node', 'node_tags')],
+                  'way': [t for t in SQL_TABLES if t[2] in ('way', 'way_nodes', 'way_tags')],
+                  'relation': [t for t in SQL_TABLES if t[2] in ('relation', 'relation_members', 'relation_tags')]}
+
+def get_changes(osc_file, tags=('node', 'way', 'relation')):
+    """Yield (action, element) for each element in an osmChange file"""
+
+    context = ET.iterparse(osc_file, events=('start', 'end'))
+    _, root = next(context)
+    action = None
+    for event, elem in context:
+        if event == 'start' and elem.tag in ('create', 'modify', 'delete'):
+            action = elem
+        elif event == 'end' and elem.tag in tags:
+            yield action.tag, elem
+            action.clear()
+        elif event == 'end' and elem.tag in ('create', 'modify', 'delete'):
+            root.clear()
+
+
+def apply_osc(osc_file, sqlite_file=sqlite_file_m, validate=False):
+    """Apply the creates, modifies and deletes of an osmChange file to the database"""
+
+    conn = sqlite3.connect(sqlite_file)
+    validator = FastValidator(SCHEMA)
+    counts = defaultdict(int)
+    summarised = has_summaries(conn)
+    summary = defaultdict(int)
+    indexed = has_address_index(conn)
+    geometry = has_way_geometry(conn)
+    spatial = has_spatial_index(conn)
+    moved, reshaped = set(), set()
+    #(version, changeset) of the deleted elements, so older edits of them stay stale
+    conn.execute('CREATE TABLE IF NOT EXISTS deleted_elements (element TEXT NOT NULL, id INTEGER NOT NULL, '
+                 'version INTEGER, changeset INTEGER, PRIMARY KEY (element, id))')
+
+    for action, element in get_changes(osc_file):
+        tables = ELEMENT_TABLES[element.tag]
+        element_id = int(element.attrib['id'])
+
+        #skip edits older than what is already in the database
+        stored = conn.execute('SELECT version, changeset FROM {0} WHERE id = ?'.format(tables[0][0]),
+                              (element_id,)).fetchone()
+        if stored is None:
+            stored = conn.execute('SELECT version, changeset FROM deleted_elements WHERE element = ? AND id = ?',
+                                  (element.tag, element_id)).fetchone()
+        if stored is not None and stored >= (int(element.attrib['version']), int(element.attrib['changeset'])):
+            counts['stale'] += 1
+            continue
+
+        if summarised:
+            stored_summary_counts(conn, element.tag, element_id, summary)
+        for table, _, _ in tables:
+            conn.execute('DELETE FROM {0} WHERE id = ?'.format(table), (element_id,))
+        if indexed:
+            conn.execute('DELETE FROM addresses WHERE rowid = ?', (address_rowid(element.tag, element_id),))
+        if spatial and element.tag == 'node':
+            moved.add(element_id)
+        if (geometry or spatial) and element.tag == 'way':
+            reshaped.add(element_id)
+        elif (geometry or spatial) and element.tag == 'node':
+            reshaped.update(way_id for (way_id,) in conn.execute('SELECT id FROM way_nodes WHERE node_id = ?',
+                                                                 (element_id,)))
+        if action == 'delete':
+            conn.execute('INSERT OR REPLACE INTO deleted_elements VALUES (?, ?, ?, ?)',
+                         (element.tag, element_id, int(element.attrib['version']), int(element.attrib['changeset'])))
+        else:
+            conn.execute('DELETE FROM deleted_elements WHERE element = ? AND id = ?', (element.tag, element_id))
+            el = shape_element(element)
+            if validate is True:
+                validate_element(el, validator)
+            for table, rows in table_rows(el):
+                conn.executemany(SQL_INSERTS[table], rows)
+            if summarised:
+                summary_counts(el, summary)
+            if indexed and address_row(el) is not None:
+                conn.execute(ADDRESS_INSERT, address_row(el))
+        counts[action] += 1
+
+    if summarised:
+        update_summaries(conn, summary)
+    if geometry:
+        update_way_geometry(conn, reshaped)
+    if spatial:
+        update_spatial_index(conn, moved, reshaped)
+    bump_user_version(conn)
+    conn.commit()
+    conn.close()
+    return dict(counts)
+
+
+# The cleaners above work one tag at a time. With batch_size set, process_map shapes elements without cleaning them and cleans the address tags of batch_size elements at once. The street, postcode and city values are collected into columns, each distinct value is cleaned once (with pandas string operations where the rule allows it), and the results are mapped back onto the tags. The same column cleaning can re-clean the address rows of an existing node_tags or ways_tags table after a rule change, without parsing the XML again.
+
+# In[23]:
+
+import numpy as np
+import pandas as pd
+
+def clean_address_columns(keys, types, values):
+    """Clean street, postcode and city values column-wise, return (new values, rows to keep)"""
+
+    keys = pd.Series(keys)
+    values = pd.Series(values, dtype=object)
+    is_addr = pd.Series(types) == 'addr'
+    cleaned = values.copy()
+    keep = np.ones(len(values), dtype=bool)
+
+    streets = is_addr & (keys == 'street')
+    if streets.any():
+        names = pd.Series(values[streets].unique(), dtype=object)
+        street_type = names.str.split().str[0]
+        flagged = ~street_type.isin(expected)
+        fixed = [update_name(name, mapping) if bad else name for name, bad in zip(names, flagged)]
+        for kind, name in zip(street_type[flagged], names[flagged]):
+            street_types[kind].add(name)
+        cleaned[streets] = values[streets].map(dict(zip(names, fixed)))
+
+    postcodes = is_addr & (keys == 'postcode')
+    if postcodes.any():
+        codes = pd.Series(values[postcodes].unique(), dtype=object)
+        bad = ~codes.str.startswith('34')
+        fixed = codes.str[:5].where(~bad, 'error')
+        code_list.update(codes[bad | (codes.str.len() > 5)])
+        cleaned[postcodes] = values[postcodes].map(dict(zip(codes, fixed)))
+        #for invalid postcodes, or from areas outside of the Herault region, do not include entry
+        keep &= ~(postcodes & (cleaned == 'error')).values
+
+    cities = is_addr & (keys == 'city')
+    if cities.any():
+        names = pd.Series(values[cities].unique(), dtype=object)
+        flagged = ~names.isin(expected_codes)
+        other_cities.update(names[flagged])
+        fixed = names.map(lambda name: mapping_city.get(name, name))
+        cleaned[cities] = values[cities].map(dict(zip(names, fixed)))
+
+    return cleaned.values, keep
+
+
+def shape_columnar(elements, batch_size=5000, quarantine=None):
+    """Shape elements without cleaning, then clean the address tags batch_size elements at a time
+
+    With a quarantine, elements that fail shaping or cleaning are added to it
+    and a None is yielded in their place, as shape_or_quarantine does.
+    """
+
+    def clean_elements(batch):
+        tags = [tag for el in batch for part in TAG_PARTS if part in el for tag in el[part]]
+        if tags:
+            values, keep = clean_address_columns([tag['key'] for tag in tags], [tag['type'] for tag in tags],
+                                                 [tag['value'] for tag in tags])
+            dropped = set()
+            for tag, value, kept in zip(tags, values, keep):
+                tag['value'] = value
+                if not kept:
+                    dropped.add(id(tag))
+            if dropped:
+                for el in batch:
+                    for part in TAG_PARTS:
+                        if part in el:
+                            el[part] = [tag for tag in el[part] if id(tag) not in dropped]
+
+    def clean_batch(batch):
+        try:
+            clean_elements(filter(None, batch))
+        except Exception:
+            if quarantine is None:
+                raise
+            #the tags are only changed once the whole batch is cleaned, so clean each element alone to find the bad ones
+            for i, el in enumerate(batch):
+                if el:
+                    try:
+                        clean_elements([el])
+                    except Exception as error:
+                        quarantine.add(el, error)
+                        batch[i] = None
+        return batch
+
+    batch = []
+    for element in elements:
+        try:
+            el = shape_element(element, clean=False)
+        except Exception as error:
+            if quarantine is None:
+                raise
+            quarantine.add(element, error)
+            el = None
+        batch.append(el)
+        if len(batch) == batch_size:
+            for el in clean_batch(batch):
+                yield el
+            batch = []
+    for el in clean_batch(batch):
+        yield el
+
+
+def reclean_tag_table(table, sqlite_file=sqlite_file_m):
+    """Re-run the address cleaning over the addr rows of node_tags or ways_tags in place"""
+
+    conn = sqlite3.connect(sqlite_file)
+    source = target = table
+    if is_interned(conn, table):
+        #views have no rowid, work on the _data table (address values are never interned)
+        target = table + '_data'
+        source = ('(SELECT t.rowid AS rowid, tag_keys.key AS key, tag_types.type AS type, t.value AS value '
+                  'FROM {0} t JOIN tag_keys USING (key_id) JOIN tag_types USING (type_id))'.format(target))
+    rows = pd.read_sql("SELECT rowid, key, type, value FROM {0} WHERE type = 'addr' "
+                       "AND key IN ('street', 'postcode', 'city')".format(source), conn)
+    values, keep = clean_address_columns(rows['key'].values, rows['type'].values, rows['value'].values)
+
+    changed = keep & (values != rows['value'].values)
+    conn.executemany('UPDATE {0} SET value = ? WHERE rowid = ?'.format(target),
+                     zip(values[changed], rows['rowid'].values[changed].tolist()))
+    conn.executemany('DELETE FROM {0} WHERE rowid = ?'.format(target),
+                     [(rowid,) for rowid in rows['rowid'].values[~keep].tolist()])
+    if has_summaries(conn):
+        counts = defaultdict(int)
+        for key, old, new, kept in zip(rows['key'].values, rows['value'].values, values, keep):
+            if not kept or new != old:
+                counts['tag_counts', (table, key, old)] -= 1
+            if kept and new != old:
+                counts['tag_counts', (table, key, new)] += 1
+        update_summaries(conn, counts)
+    bump_user_version(conn)
+    conn.commit()
+    indexed = has_address_index(conn)
+    conn.close()
+    if indexed:
+        build_address_index(sqlite_file)
+    return {'updated': int(changed.sum()), 'deleted': int((~keep).sum())}
+
+
+# shape_element turns every node into a dict of eight strings, which is a lot of memory for the 854,439 nodes of the full file. For working with coordinates in Python, NodeStore keeps the nodes in numpy arrays instead: int64 ids sorted for binary search, float64 lat/lon, and an index into an interned table of users and their uids. WayStore keeps the node refs of every way in one int64 array with the offset where each way starts, so all the ways can be resolved to coordinates at once without joining way_nodes back to nodes.
+
+# In[24]:
+
+class ArrayBuilder(object):
+    """Append-only numpy array, filled through a small python list to keep appends cheap"""
+
+    def __init__(self, dtype, chunk_size=100000):
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.buffer = []
+        self.size = 0
+
+    def append(self, value):
+        self.buffer.append(value)
+        self.size += 1
+        if len(self.buffer) == self.chunk_size:
+            self.chunks.append(np.array(self.buffer, dtype=self.dtype))
+            self.buffer = []
+
+    def __len__(self):
+        return self.size
+
+    def array(self):
+        return np.concatenate(self.chunks + [np.array(self.buffer, dtype=self.dtype)])
+
+
+def id_condition(ids, column='id'):
+    """WHERE clause restricting a query to the given ids, written out (ids are integers) to avoid the limit on parameters"""
+    if ids is None:
+        return ''
+    return ' WHERE {0} IN ({1})'.format(column, ', '.join(str(int(i)) for i in ids))
+
+
+class NodeStore(object):
+    """Nodes as sorted numpy arrays with an interned user/uid table"""
+
+    def __init__(self, ids, lat, lon, user_index, users, uids):
+        ids = np.asarray(ids, dtype=np.int64)
+        order = None if np.all(ids[1:] >= ids[:-1]) else np.argsort(ids, kind='mergesort')
+        take = (lambda a: a) if order is None else (lambda a: a[order])
+        self.ids = take(ids)
+        self.lat = take(np.asarray(lat, dtype=np.float64))
+        self.lon = take(np.asarray(lon, dtype=np.float64))
+        self.user_index = take(np.asarray(user_index, dtype=np.int32))
+        self.users = list(users)
+        self.uids = np.asarray(uids, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def find(self, node_ids):
+        """Positions of node_ids in the store, and whether each one was found"""
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        positions = np.searchsorted(self.ids, node_ids)
+        positions[positions == len(self.ids)] = 0
+        found = self.ids[positions] == node_ids if len(self.ids) else np.zeros(len(node_ids), dtype=bool)
+        return positions, found
+
+    def coords(self, node_ids):
+        """lat and lon arrays for node_ids, nan where the node isn't in the store"""
+        positions, found = self.find(node_ids)
+        lat = np.where(found, self.lat[positions], np.nan)
+        lon = np.where(found, self.lon[positions], np.nan)
+        return lat, lon
+
+    def node(self, node_id):
+        positions, found = self.find([node_id])
+        if not found[0]:
+            return None
+        i = positions[0]
+        user = self.user_index[i]
+        return {'id': int(self.ids[i]), 'lat': float(self.lat[i]), 'lon': float(self.lon[i]),
+                'user': self.users[user], 'uid': int(self.uids[user])}
+
+    @classmethod
+    def from_sqlite(cls, sqlite_file=sqlite_file_m, conn=None, node_ids=None):
+        """All the nodes of a database, or only node_ids, read through conn if given"""
+        own = conn is None
+        if own:
+            conn = sqlite3.connect(sqlite_file)
+        nodes = pd.read_sql('SELECT id, lat, lon, user, uid FROM nodes{0} ORDER BY id'.format(id_condition(node_ids)), conn)
+        if own:
+            conn.close()
+        codes, users = pd.factorize(nodes['user'])
+        uids = nodes.groupby(codes)['uid'].first().values
+        return cls(nodes['id'].values, nodes['lat'].values, nodes['lon'].values, codes, users, uids)
+
+
+class WayStore(object):
+    """Node refs of all ways in one array, way i uses refs[offsets[i]:offsets[i + 1]]"""
+
+    def __init__(self, ids, offsets, refs):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.refs = np.asarray(refs, dtype=np.int64)
+        self.order = np.argsort(self.ids, kind='mergesort')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def resolve(self, node_store):
+        """lat and lon for every ref of every way, in one lookup"""
+        return node_store.coords(self.refs)
+
+    @classmethod
+    def from_sqlite(cls, sqlite_file=sqlite_file_m, conn=None, way_ids=None):
+        """The refs of all the ways in way_nodes, or only of way_ids, read through conn if given"""
+        own = conn is None
+        if own:
+            conn = sqlite3.connect(sqlite_file)
+        rows = pd.read_sql('SELECT id, node_id FROM way_nodes{0} ORDER BY id, position'.format(id_condition(way_ids)), conn)
+        if own:
+            conn.close()
+        ids, starts = np.unique(rows['id'].values, return_index=True)
+        return cls(ids, np.append(starts, len(rows)), rows['node_id'].values)
+
+    def way_refs(self, way_id):
+        i = np.searchsorted(self.ids, way_id, sorter=self.order)
+        if i == len(self.ids) or self.ids[self.order[i]] != way_id:
+            return None
+        i = self.order[i]
+        return self.refs[self.offsets[i]:self.offsets[i + 1]]
+
+
+def build_stores(osm_file):
+    """Read the nodes and ways of an osm file into a NodeStore and a WayStore in one pass"""
+
+    node_ids, lat, lon = ArrayBuilder(np.int64), ArrayBuilder(np.float64), ArrayBuilder(np.float64)
+    user_index, users, uids, user_codes = ArrayBuilder(np.int32), [], [], {}
+    way_ids, offsets, refs = ArrayBuilder(np.int64), ArrayBuilder(np.int64), ArrayBuilder(np.int64)
+    offsets.append(0)
+
+    for element in get_element(osm_file, tags=('node', 'way')):
+        attrib = element.attrib
+        if element.tag == 'node':
+            node_ids.append(int(attrib['id']))
+            lat.append(float(attrib['lat']))
+            lon.append(float(attrib['lon']))
+            user = attrib.get('user', '')
+            if user not in user_codes:
+                user_codes[user] = len(users)
+                users.append(user)
+                uids.append(int(attrib.get('uid', 0)))
+            user_index.append(user_codes[user])
+        else:
+            way_ids.append(int(attrib['id']))
+            for nd in element.iter('nd'):
+                if nd.attrib.get('ref'):
+                    refs.append(int(nd.attrib['ref']))
+            offsets.append(len(refs))
+
+    node_store = NodeStore(node_ids.array(), lat.array(), lon.array(), user_index.array(), users, uids)
+    way_store = WayStore(way_ids.array(), offsets.array(), refs.array())
+    return node_store, way_store
+
+
+# The questions I actually want to ask are spatial ("which restaurants are within 500 metres of Place de la Comédie?"), and without an index each one is a scan of nodes joined to node_tags. build_spatial_index adds two SQLite R*Tree tables: nodes_rtree with a point for every node, and ways_rtree with the bounding box of every way. SqliteSink(spatial_index=True) builds them at the end of a load, and apply_osc replaces the rows of the nodes it changes and of the ways they (or the diff) change. The query functions below probe the R*Tree first, then check the exact coordinates (and tags) of the few candidates left.
+
+# In[25]:
+
+import math
+
+EARTH_RADIUS = 6371008.8 #metres
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great circle distance in metres, works on floats or numpy arrays"""
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+def build_spatial_index(conn):
+    """(Re)build the R*Tree tables over node points and way bounding boxes"""
+    conn.execute('DROP TABLE IF EXISTS nodes_rtree')
+    conn.execute('DROP TABLE IF EXISTS ways_rtree')
+    conn.execute('CREATE VIRTUAL TABLE nodes_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)')
+    conn.execute('CREATE VIRTUAL TABLE ways_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)')
+    conn.execute('INSERT INTO nodes_rtree SELECT id, lat, lat, lon, lon FROM nodes')
+    conn.execute('INSERT INTO ways_rtree SELECT w.id, MIN(n.lat), MAX(n.lat), MIN(n.lon), MAX(n.lon) '
+                 'FROM way_nodes w JOIN nodes n ON n.id = w.node_id GROUP BY w.id')
+    conn.commit()
+
+def has_spatial_index(conn):
+    return conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name IN ('nodes_rtree', 'ways_rtree')").fetchone()[0] == 2
+
+def update_spatial_index(conn, node_ids, way_ids):
+    """Replace the R*Tree rows of node_ids and way_ids, dropping the ones of elements that no longer exist"""
+    node_ids, way_ids = sorted(set(node_ids)), sorted(set(way_ids))
+    if node_ids:
+        conn.execute('DELETE FROM nodes_rtree' + id_condition(node_ids))
+        conn.execute('INSERT INTO nodes_rtree SELECT id, lat, lat, lon, lon FROM nodes' + id_condition(node_ids))
+    if way_ids:
+        conn.execute('DELETE FROM ways_rtree' + id_condition(way_ids))
+        conn.execute('INSERT INTO ways_rtree SELECT w.id, MIN(n.lat), MAX(n.lat), MIN(n.lon), MAX(n.lon) '
+                     'FROM way_nodes w JOIN nodes n ON n.id = w.node_id' + id_condition(way_ids, 'w.id') +
+                     ' GROUP BY w.id')
+
+def tag_filter(table, key, value):
+    """SQL condition and parameters restricting an element to the ones with a key (and value) tag"""
+    if key is None:
+        return '', ()
+    if value is None:
+        return ' AND EXISTS (SELECT 1 FROM {0} t WHERE t.id = e.id AND t.key = ?)'.format(table), (key,)
+    return ' AND EXISTS (SELECT 1 FROM {0} t WHERE t.id = e.id AND t.key = ? AND t.value = ?)'.format(table), (key, value)
+
+def query_bbox(conn, min_lat, min_lon, max_lat, max_lon, key=None, value=None, element='node'):
+    """Nodes (id, lat, lon) inside the box, or ways (id, min_lat, min_lon, max_lat, max_lon) overlapping it"""
+    if element == 'node':
+        condition, params = tag_filter('node_tags', key, value)
+        sql = ('SELECT e.id, e.lat, e.lon FROM nodes_rtree r JOIN nodes e ON e.id = r.id '
+               'WHERE r.min_lat <= ? AND r.max_lat >= ? AND r.min_lon <= ? AND r.max_lon >= ? '
+               'AND e.lat BETWEEN ? AND ? AND e.lon BETWEEN ? AND ?' + condition)
+        return conn.execute(sql, (max_lat, min_lat, max_lon, min_lon, min_lat, max_lat, min_lon, max_lon) + params).fetchall()
+    condition, params = tag_filter('ways_tags', key, value)
+    sql = ('SELECT e.id, e.min_lat, e.min_lon, e.max_lat, e.max_lon FROM ways_rtree e '
+           'WHERE e.min_lat <= ? AND e.max_lat >= ? AND e.min_lon <= ? AND e.max_lon >= ?' + condition)
+    return conn.execute(sql, (max_lat, min_lat, max_lon, min_lon) + params).fetchall()
+
+def query_radius(conn, lat, lon, metres, key=None, value=None):
+    """Nodes within metres of a point as (distance, id, lat, lon), nearest first"""
+    dlat = math.degrees(metres / EARTH_RADIUS)
+    dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+    found = []
+    for node_id, node_lat, node_lon in query_bbox(conn, lat - dlat, lon - dlon, lat + dlat, lon + dlon, key, value):
+        distance = float(haversine(lat, lon, node_lat, node_lon))
+        if distance <= metres:
+            found.append((distance, node_id, node_lat, node_lon))
+    return sorted(found)
+
+def query_nearest(conn, lat, lon, k=10, key=None, value=None, start_metres=100, max_metres=50000):
+    """The k nodes nearest to a point as (distance, id, lat, lon), widening the search radius as needed"""
+    metres = start_metres
+    while True:
+        found = query_radius(conn, lat, lon, metres, key, value)
+        #everything within the radius has been found, so the k nearest are exact once there are k of them
+        if len(found) >= k or metres >= max_metres:
+            return found[:k]
+        metres *= 2
+
+def query_polygon(conn, polygon, key=None, value=None):
+    """Nodes (id, lat, lon) inside a polygon given as a list of (lat, lon) points"""
+    lats = [p[0] for p in polygon]
+    lons = [p[1] for p in polygon]
+    inside = []
+    for node_id, node_lat, node_lon in query_bbox(conn, min(lats), min(lons), max(lats), max(lons), key, value):
+        #ray casting: count the polygon edges crossed going east from the point
+        crossings = False
+        for i in range(len(polygon)):
+            lat1, lon1 = polygon[i - 1]
+            lat2, lon2 = polygon[i]
+            if (lat1 > node_lat) != (lat2 > node_lat):
+                if node_lon < lon1 + (node_lat - lat1) * (lon2 - lon1) / (lat2 - lat1):
+                    crossings = not crossings
+        if crossings:
+            inside.append((node_id, node_lat, node_lon))
+    return inside
+
+
+# Computing the length of a road or the area of a building in SQL means joining ways_tags to way_nodes and way_nodes back to nodes, then walking the nodes of each way in order. build_way_geometry does it once for every way, after a load: it reads the ways with WayStore.from_sqlite and the nodes with NodeStore.from_sqlite, resolves all the refs to coordinates in one lookup, and computes with numpy, for all the ways at once, the length (haversine, in metres), the bounding box, the centroid (the mean of the nodes, the closing node counted once) and, for closed ways, the area in square metres (shoelace formula on coordinates projected around the centroid, which is close enough at the size of a building or a park). The results go into the way_geometry table, one row per way, keyed by the way id, so road lengths and building footprints are a join of ways_tags (through its key index) with way_geometry. missing counts the refs of a way whose node isn't in the extract; those ways get no area. SqliteSink(way_geometry=True) builds the table at the end of a load, and apply_osc recomputes the rows of the ways it changes or whose nodes it changes.
+
+# In[34]:
+
+WAY_GEOMETRY_FIELDS = ('id', 'nodes', 'missing', 'closed', 'length', 'area',
+                       'min_lat', 'max_lat', 'min_lon', 'max_lon', 'centroid_lat', 'centroid_lon')
+
+def create_way_geometry(conn, replace=False):
+    if replace:
+        conn.execute('DROP TABLE IF EXISTS way_geometry')
+    conn.execute('CREATE TABLE IF NOT EXISTS way_geometry (id INTEGER PRIMARY KEY NOT NULL, nodes INTEGER, '
+                 'missing INTEGER, closed INTEGER, length REAL, area REAL, min_lat REAL, max_lat REAL, '
+                 'min_lon REAL, max_lon REAL, centroid_lat REAL, centroid_lon REAL)')
+
+
+def has_way_geometry(conn):
+    return conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'way_geometry'").fetchone()[0] == 1
+
+
+def way_geometry(node_store, way_store):
+    """DataFrame with the WAY_GEOMETRY_FIELDS of every way of way_store"""
+
+    lat, lon = way_store.resolve(node_store)
+    starts, ends = way_store.offsets[:-1], way_store.offsets[1:]
+    counts = ends - starts
+    n = len(way_store)
+    way = np.repeat(np.arange(n), counts) #way of every ref
+    found = ~np.isnan(lat)
+    nonempty = counts > 0
+
+    def per_way(index, weights):
+        #sum of weights for each way (bincount gives ints when there are no weights at all)
+        return np.bincount(index, weights=weights, minlength=n).astype(np.float64)
+
+    last = ends[nonempty] - 1
+
+    closed = np.zeros(n, dtype=bool)
+    closed[nonempty] = (counts[nonempty] >= 4) & (way_store.refs[starts[nonempty]] == way_store.refs[last])
+    missing = counts - per_way(way, found).astype(np.int64)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        #segment i goes from ref i to ref i + 1 of the same way
+        segment = (way[1:] == way[:-1]) & found[1:] & found[:-1]
+        lengths = haversine(lat[:-1][segment], lon[:-1][segment], lat[1:][segment], lon[1:][segment])
+        length = per_way(way[:-1][segment], lengths)
+
+        columns = {}
+        for name, values in (('lat', lat), ('lon', lon)):
+            columns['min_' + name] = np.full(n, np.nan)
+            columns['max_' + name] = np.full(n, np.nan)
+            columns['min_' + name][nonempty] = np.fmin.reduceat(values, starts[nonempty])
+            columns['max_' + name][nonempty] = np.fmax.reduceat(values, starts[nonempty])
+
+        weight = found.astype(np.float64)
+        weight[last[closed[nonempty]]] = 0
+        total = per_way(way, weight)
+        centroid_lat = per_way(way, np.where(found, lat, 0) * weight) / total
+        centroid_lon = per_way(way, np.where(found, lon, 0) * weight) / total
+
+        #metres east and north of the centroid
+        y = np.radians(lat - centroid_lat[way]) * EARTH_RADIUS
+        x = np.radians(lon - centroid_lon[way]) * np.cos(np.radians(centroid_lat[way])) * EARTH_RADIUS
+        cross = x[:-1][segment] * y[1:][segment] - x[1:][segment] * y[:-1][segment]
+        area = np.abs(per_way(way[:-1][segment], cross)) / 2
+    area[~closed | (missing > 0)] = np.nan
+
+    columns.update({'id': way_store.ids, 'nodes': counts, 'missing': missing, 'closed': closed.astype(int),
+                    'length': length, 'area': area, 'centroid_lat': centroid_lat, 'centroid_lon': centroid_lon})
+    return pd.DataFrame(columns, columns=list(WAY_GEOMETRY_FIELDS))
+
+
+def write_way_geometry(conn, geometry):
+    rows = geometry.astype(object).where(geometry.notnull(), None).values.tolist()
+    conn.executemany('INSERT OR REPLACE INTO way_geometry ({0}) VALUES ({1})'.format(
+        ', '.join(WAY_GEOMETRY_FIELDS), ', '.join('?' * len(WAY_GEOMETRY_FIELDS))), rows)
+
+
+def build_way_geometry(conn):
+    """(Re)build the way_geometry table for every way of the database"""
+    geometry = way_geometry(NodeStore.from_sqlite(conn=conn), WayStore.from_sqlite(conn=conn))
+    create_way_geometry(conn, replace=True)
+    write_way_geometry(conn, geometry)
+    bump_user_version(conn)
+    conn.commit()
+    return len(geometry)
+
+
+def update_way_geometry(conn, way_ids):
+    """Recompute the rows of way_ids, dropping the ones of ways that no longer exist"""
+    way_ids = sorted(set(way_ids))
+    if not way_ids:
+        return
+    conn.execute('DELETE FROM way_geometry' + id_condition(way_ids))
+    way_store = WayStore.from_sqlite(conn=conn, way_ids=way_ids)
+    node_store = NodeStore.from_sqlite(conn=conn, node_ids=np.unique(way_store.refs))
+    write_way_geometry(conn, way_geometry(node_store, way_store))
+
+
+# conn = sqlite3.connect(sqlite_file)
+# build_way_geometry(conn)
+# 
+# #total length of each kind of road, in km
+# conn.execute("SELECT t.value, SUM(g.length) / 1000 FROM ways_tags t JOIN way_geometry g ON g.id = t.id "
+#              "WHERE t.key = 'highway' GROUP BY t.value ORDER BY 2 DESC").fetchall()
+# 
+# #building footprints
+# conn.execute("SELECT COUNT(*), SUM(g.area), AVG(g.area) FROM ways_tags t JOIN way_geometry g ON g.id = t.id "
+#              "WHERE t.key = 'building' AND g.area IS NOT NULL").fetchall()
+
+
+# Clipped extracts like sample2.osm have ways whose nd refs point to nodes that aren't in the file, and shape_element writes those refs into way_nodes without checking. Finding them afterwards is a LEFT JOIN of way_nodes to nodes over the whole table. IntegrityChecker does the check during the process_map pass instead: it keeps the ids of the nodes seen so far in a sorted int64 array, with one flag per node for "tagged or used by a way or relation", and looks the refs of each way up in it with np.searchsorted. This relies on the usual order of an OSM file, nodes before ways; nodes that come later are merged into the array before the next lookup. With action='report' every way is kept and only counted, with 'drop' the ways with a dangling ref are left out, and with 'quarantine' they are written to the quarantine file of process_map with the missing refs. report() gives the number of broken ways and dangling refs, the distinct missing node ids, and the nodes that are neither tagged nor used, which can only be known once the whole file has been read. At a checkpoint the arrays are saved next to the checkpoint file, so a resumed run carries on with them.
+
+# In[35]:
+
+INTEGRITY_ACTIONS = ('report', 'drop', 'quarantine')
+
+class IntegrityChecker(object):
+    """Check the nd refs of shaped ways against the node ids seen so far"""
+
+    def __init__(self, action='report', examples=10):
+        if action not in INTEGRITY_ACTIONS:
+            raise ValueError('action must be one of {0}'.format(', '.join(INTEGRITY_ACTIONS)))
+        self.action = action
+        self.max_examples = examples
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.used = np.zeros(0, dtype=bool)
+        self.new_ids = ArrayBuilder(np.int64)
+        self.new_used = ArrayBuilder(np.bool_)
+        self.missing = []
+        self.counts = defaultdict(int)
+        self.examples = []
+
+    def merge(self):
+        """Move the nodes added since the last lookup into the sorted arrays"""
+        if not len(self.new_ids):
+            return
+        ids = np.concatenate([self.ids, self.new_ids.array()])
+        used = np.concatenate([self.used, self.new_used.array()])
+        if not np.all(ids[1:] >= ids[:-1]):
+            order = np.argsort(ids, kind='mergesort')
+            ids, used = ids[order], used[order]
+        self.ids, self.used = ids, used
+        self.new_ids, self.new_used = ArrayBuilder(np.int64), ArrayBuilder(np.bool_)
+
+    def lookup(self, refs):
+        """Mark the refs found as used and return the ones that aren't nodes"""
+        self.merge()
+        refs = np.array(refs, dtype=np.int64)
+        positions = np.searchsorted(self.ids, refs)
+        positions[positions == len(self.ids)] = 0
+        found = self.ids[positions] == refs if len(self.ids) else np.zeros(len(refs), dtype=bool)
+        self.used[positions[found]] = True
+        return refs[~found]
+
+    def check(self, el, quarantine=None):
+        """Return the element, or None for a broken way that is dropped or quarantined"""
+        if 'node' in el:
+            self.new_ids.append(int(el['node']['id']))
+            self.new_used.append(bool(el['node_tags']))
+            self.counts['nodes'] += 1
+        elif 'relation' in el:
+            self.lookup([member['member_id'] for member in el['relation_members'] if member['member_type'] == 'node'])
+        elif 'way' in el:
+            self.counts['ways'] += 1
+            dangling = self.lookup([nd['node_id'] for nd in el['way_nodes']])
+            if len(dangling):
+                self.counts['broken_ways'] += 1
+                self.counts['dangling_refs'] += len(dangling)
+                self.missing.append(dangling)
+                if len(self.examples) < self.max_examples:
+                    self.examples.append(int(el['way']['id']))
+                if self.action != 'report':
+                    self.counts['dropped_ways'] += 1
+                    if self.action == 'quarantine':
+                        quarantine.add(el, 'dangling nd refs: ' + ', '.join(str(ref) for ref in dangling))
+                    return None
+        return el
+
+    def missing_nodes(self):
+        """Distinct ids of the nodes referenced by ways but not in the file"""
+        self.missing = [np.unique(np.concatenate(self.missing))] if self.missing else []
+        return self.missing[0] if self.missing else np.zeros(0, dtype=np.int64)
+
+    def unused_nodes(self):
+        """Ids of the nodes without tags that no way or relation uses"""
+        self.merge()
+        return self.ids[~self.used]
+
+    def report(self):
+        report = dict((name, self.counts[name]) for name in ('nodes', 'ways', 'broken_ways', 'dangling_refs',
+                                                              'dropped_ways'))
+        report['missing_nodes'] = len(self.missing_nodes())
+        report['unused_nodes'] = len(self.unused_nodes())
+        report['broken_way_examples'] = self.examples
+        return report
+
+    def checkpoint(self, path):
+        """Save the arrays to path and return the rest of the state for the checkpoint file"""
+        self.merge()
+        with open(path + '.tmp', 'wb') as fout:
+            np.savez(fout, ids=self.ids, used=self.used, missing=self.missing_nodes())
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(path + '.tmp', path)
+        return {'path': path, 'counts': dict(self.counts), 'examples': self.examples}
+
+    def resume(self, state):
+        arrays = np.load(state['path'])
+        self.ids, self.used = arrays['ids'], arrays['used']
+        self.missing = [arrays['missing']]
+        self.counts = defaultdict(int, state['counts'])
+        self.examples = state['examples']
+
+
+# checker = IntegrityChecker('quarantine')
+# process_map(SAMPLE_FILE, validate=True, sink=SqliteSink(), integrity=checker, quarantine_path='quarantine.jsonl')
+# checker.report()
+
+
+# Relations (bus routes, administrative boundaries, multipolygon buildings and parks) are stored in the relations, relation_members and relation_tags tables. A multipolygon is made of member ways with the role outer or inner that have to be joined end to end into closed rings. build_multipolygons gets every member way of the multipolygon and boundary relations, with the coordinates of their nodes, in one ordered query instead of one query per member. It then joins the ways into rings in Python. Rings that can't be closed (for example when a member way is outside the extract), or that have nodes missing from the extract, are reported under 'open', and the other rings of the relation are still joined.
+
+# In[27]:
+
+def join_rings(ways):
+    """Join ways (lists of (node_id, lat, lon)) end to end into closed rings, return (rings, leftover ways)
+
+    Chains that can't be closed, or that have a node without coordinates
+    (lat None), are returned with the leftovers.
+    """
+    rings, leftover, unused = [], [], [way for way in ways if way]
+    while unused:
+        ring = list(unused.pop(0))
+        #keep adding a way that continues from the end of the ring until it closes
+        while ring[0][0] != ring[-1][0]:
+            for i, way in enumerate(unused):
+                if way[0][0] == ring[-1][0]:
+                    ring.extend(way[1:])
+                elif way[-1][0] == ring[-1][0]:
+                    ring.extend(reversed(way[:-1]))
+                else:
+                    continue
+                del unused[i]
+                break
+            else:
+                break
+        if ring[0][0] == ring[-1][0] and len(ring) >= 4 and all(lat is not None for _, lat, _ in ring):
+            rings.append([(lat, lon) for node_id, lat, lon in ring])
+        else:
+            leftover.append(ring)
+    return rings, leftover
+
+
+def build_multipolygons(sqlite_file=sqlite_file_m, relation_types=('multipolygon', 'boundary')):
+    """Outer and inner rings of every multipolygon relation, as {relation id: {'outer': [...], 'inner': [...]}}"""
+
+    conn = sqlite3.connect(sqlite_file)
+    rows = conn.execute(
+        'SELECT m.id, m.position, m.role, w.node_id, n.lat, n.lon '
+        'FROM relation_members m '
+        "JOIN relation_tags t ON t.id = m.id AND t.key = 'type' AND t.value IN ({0}) "
+        'JOIN way_nodes w ON w.id = m.member_id '
+        'LEFT JOIN nodes n ON n.id = w.node_id '
+        "WHERE m.member_type = 'way' "
+        'ORDER BY m.id, m.position, w.position'.format(', '.join('?' * len(relation_types))), relation_types)
+
+    polygons = {}
+    def assemble(relation_id, members):
+        polygon = {'outer': [], 'inner': [], 'open': []}
+        for role in ('outer', 'inner'):
+            #members without a role are treated as outer
+            ways = [way for way_role, way in members if (way_role or 'outer') == role]
+            rings, leftover = join_rings(ways)
+            polygon[role] = rings
+            polygon['open'].extend(leftover)
+        polygons[relation_id] = polygon
+
+    current, members, key = None, [], None
+    for relation_id, position, role, node_id, lat, lon in rows:
+        if relation_id != current:
+            if current is not None:
+                assemble(current, members)
+            current, members, key = relation_id, [], None
+        if (relation_id, position) != key:
+            key = (relation_id, position)
+            members.append((role, []))
+        members[-1][1].append((node_id, lat, lon))
+    if current is not None:
+        assemble(current, members)
+
+    conn.close()
+    return polygons
+
+
+# ### Benchmarks
+# 
+# To tell whether a change to shape_element, the cleaners or the writers makes the pipeline faster or slower, run_benchmarks times each stage separately on a file and writes the results as JSON, so runs from different commits can be compared with compare_benchmarks. The stages are: parsing with get_element, shape_element, address cleaning (per value and columnar), validation, writing the .csv files, writing to SQLite, build_way_geometry on the SQLite database, and upload_all_to_sql. Each stage reports its time and elements per second, and the run reports the peak memory. make_scaled_sample builds bigger test files from sample2.osm by repeating it with shifted ids, so the scaling can be checked without the full extract.
+# 
+# make_scaled_sample(SAMPLE_FILE, 10, 'sample_x10.osm')
+# run_benchmarks('sample_x10.osm', 'benchmark.json')
+
+# In[26]:
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+SCALED_ID_OFFSET = 10 ** 11 #larger than any OSM id, so the copies never collide
+
+def make_scaled_sample(osm_file, factor, out_file):
+    """Write osm_file repeated factor times with shifted ids, keeping nodes, ways and relations in order"""
+    with open(out_file, 'wb') as output:
+        output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        output.write('<osm>\n  ')
+        for element_type in ('node', 'way', 'relation'):
+            for copy in range(factor):
+                offset = copy * SCALED_ID_OFFSET
+                for element in get_element(osm_file, tags=(element_type,)):
+                    element.attrib['id'] = str(int(element.attrib['id']) + offset)
+                    for nd in element.iter('nd'):
+                        nd.attrib['ref'] = str(int(nd.attrib['ref']) + offset)
+                    for member in element.iter('member'):
+                        member.attrib['ref'] = str(int(member.attrib['ref']) + offset)
+                    output.write(ET.tostring(element, encoding='utf-8'))
+        output.write('</osm>')
+
+
+def git_commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(osm_file, out_path=None):
+    """Time each stage of the pipeline on osm_file and return (and optionally save) the results"""
+
+    stages = {}
+    def record(stage, seconds, count):
+        stages[stage] = {'seconds': seconds, 'count': count,
+                         'per_second': count / seconds if seconds else None}
+
+    #parsing and shaping, timed separately within the same pass
+    parse_time = shape_time = 0.0
+    shaped = []
+    elements = get_element(osm_file, tags=('node', 'way'))
+    while True:
+        start = time.time()
+        element = next(elements, None)
+        parse_time += time.time() - start
+        if element is None:
+            break
+        start = time.time()
+        el = shape_element(element, clean=False)
+        shape_time += time.time() - start
+        if el:
+            shaped.append(el)
+    record('parse', parse_time, len(shaped))
+    record('shape', shape_time, len(shaped))
+
+    #address cleaning, on throwaway reference sets so the globals are left alone
+    tags = [tag for el in shaped for part in TAG_PARTS if part in el for tag in el[part]]
+    address = [tag for tag in tags if tag['type'] == 'addr' and tag['key'] in ('street', 'postcode', 'city')]
+    cleaner = AddressCleaner()
+    found_streets, found_codes, found_cities = defaultdict(set), set(), set()
+    start = time.time()
+    for tag in address:
+        if tag['key'] == 'street':
+            cleaner.street(found_streets, tag['value'])
+        elif tag['key'] == 'postcode':
+            cleaner.postcode(tag['value'], found_codes)
+        else:
+            cleaner.city(tag['value'], found_cities)
+    record('clean', time.time() - start, len(address))
+    start = time.time()
+    clean_address_columns([tag['key'] for tag in tags], [tag['type'] for tag in tags], [tag['value'] for tag in tags])
+    record('clean_columnar', time.time() - start, len(tags))
+
+    validator = FastValidator(SCHEMA)
+    start = time.time()
+    for el in shaped:
+        validator.validate(el, SCHEMA)
+    record('validate', time.time() - start, len(shaped))
+
+    #writers, in a scratch directory since the csv paths are relative
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.chdir(workdir)
+        start = time.time()
+        sink = CsvSink()
+        for el in shaped:
+            sink.write(el)
+        sink.close()
+        record('write_csv', time.time() - start, len(shaped))
+
+        start = time.time()
+        sink = SqliteSink('benchmark.db')
+        for el in shaped:
+            sink.write(el)
+        sink.close()
+        record('write_sqlite', time.time() - start, len(shaped))
+
+        conn = sqlite3.connect('benchmark.db')
+        start = time.time()
+        ways = build_way_geometry(conn)
+        record('way_geometry', time.time() - start, ways)
+        conn.close()
+
+        start = time.time()
+        loaded = upload_all_to_sql('upload.db', workers=1)
+        record('upload_all_to_sql', time.time() - start, sum(loaded.values()))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+    results = {'file': osm_file, 'bytes': os.path.getsize(osm_file), 'elements': len(shaped),
+               'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'peak_memory_mb': peak_memory_mb(), 'stages': stages}
+    if out_path is not None:
+        with open(out_path, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return results
+
+
+def compare_benchmarks(old_path, new_path, threshold=0.1):
+    """Stages whose throughput dropped by more than threshold between two benchmark files"""
+    with open(old_path) as f:
+        old = json.load(f)['stages']
+    with open(new_path) as f:
+        new = json.load(f)['stages']
+    slower = {}
+    for stage, result in new.iteritems():
+        before = old.get(stage, {}).get('per_second')
+        if before and result['per_second'] and result['per_second'] < before * (1 - threshold):
+            slower[stage] = {'before': before, 'after': result['per_second']}
+    return slower
+
+
+# With everything above defined, the database is loaded from the .csv files written by process_map, in this process (see upload_all_to_sql).
+
+# In[36]:
+
+pprint(upload_all_to_sql(sqlite_file_m, workers=1))
 
 
 # ## Section 3. User Contribution Analysis
@@ -567,24 +3700,19 @@ import pandas as pd
 sqlite_file = r"C:\Users\schro\Desktop\Projects\Data Analysis Nanodegree\P3- Data Wrangling\CSV_Exports\montpellier.db"    # name of the sqlite database file
 
 
-# Connecting to the database file
-conn = sqlite3.connect(sqlite_file)
-c = conn.cursor()
+# Pooled connections to the database file
+analysis_db = get_analysis_db(sqlite_file)
 
 #select uid from nodes and ways, union matches pairs without including duplicates
-c.execute('SELECT COUNT(*) FROM (SELECT uid FROM nodes UNION SELECT uid FROM ways);')
-all_rows = c.fetchall()
+all_rows = analysis_db.query('SELECT COUNT(*) FROM (SELECT uid FROM nodes UNION SELECT uid FROM ways);')
 pprint(all_rows)
 
 #select user entry data
-c.execute('SELECT user,COUNT(*) as num FROM (SELECT user FROM nodes UNION ALL SELECT user FROM ways) e GROUP BY e.user ORDER BY num DESC;')
-all_rows = c.fetchall()
+all_rows = analysis_db.query('SELECT user,COUNT(*) as num FROM (SELECT user FROM nodes UNION ALL SELECT user FROM ways) e GROUP BY e.user ORDER BY num DESC;')
 
 #look at user entry statistics
 user_counts=pd.DataFrame(all_rows)
 print user_counts[1].describe()
-# Closing the connection to the database file
-conn.close()
 
 
 # ## Landmarks in Montpellier
@@ -599,34 +3727,26 @@ import pandas as pd
 sqlite_file = "montpellier.db"    # name of the sqlite database file
 
 
-# Connecting to the database file
-conn = sqlite3.connect(sqlite_file)
-c = conn.cursor()
+# Pooled connections to the database file
+analysis_db = get_analysis_db(sqlite_file)
 
 #investigate tag types
-c.execute('SELECT key, COUNT(*) FROM node_tags GROUP BY key ORDER BY COUNT(*) DESC LIMIT 10;')
-all_rows = c.fetchall()
+all_rows = analysis_db.query('SELECT key, COUNT(*) FROM node_tags GROUP BY key ORDER BY COUNT(*) DESC LIMIT 10;')
 pprint(all_rows)
 print("\n")
 
-c.execute('SELECT value, COUNT(*) as num FROM node_tags WHERE key="cuisine" GROUP BY value ORDER BY num DESC LIMIT 10;')
-all_rows = c.fetchall()
+all_rows = analysis_db.query('SELECT value, COUNT(*) as num FROM node_tags WHERE key="cuisine" GROUP BY value ORDER BY num DESC LIMIT 10;')
 pprint(all_rows)
 print("\n")
 
-c.execute('SELECT value, COUNT(*) as num FROM node_tags WHERE key="shop" GROUP BY value ORDER BY num DESC LIMIT 10;')
-all_rows = c.fetchall()
+all_rows = analysis_db.query('SELECT value, COUNT(*) as num FROM node_tags WHERE key="shop" GROUP BY value ORDER BY num DESC LIMIT 10;')
 pprint(all_rows)
 print("\n")
 
 
-c.execute('SELECT value, COUNT(*) as num FROM node_tags WHERE key="species" GROUP BY value ORDER BY num DESC LIMIT 5;')
-all_rows = c.fetchall()
+all_rows = analysis_db.query('SELECT value, COUNT(*) as num FROM node_tags WHERE key="species" GROUP BY value ORDER BY num DESC LIMIT 5;')
 pprint(all_rows)
 print("\n")
 
-# Closing the connection to the database file
-conn.close()
-
 
 